@@ -3,13 +3,38 @@ from langchain_core.messages import HumanMessage, SystemMessage # type: ignore
 from langchain_core.runnables.config import RunnableConfig # type: ignore
 from langgraph.types import StreamWriter # type: ignore
 
+from typing import Annotated
+import numpy as np # type: ignore
+import operator
+import asyncio
+import json
+import os
 import re
-import uuid
 
-from models.llm import get_chat_model
+from models.llm import astream_until, get_chat_model, stream_until
 from utils.db_client import ConnectPostgres 
-from utils.maps import get_restaurants
-from utils.graph_utils import check_preference_negative, check_preference_score, remove_duplicates
+from utils.maps import afind_local_restaurants, find_local_restaurants, get_restaurants, search_place_ids
+from utils.graph_utils import check_preference_score, negative_preference_mask, remove_duplicates
+from utils.ranking import aget_review_vectors, cosine_similarity, get_review_vectors
+from utils.route_classifier import ROUTES, route_classifier
+from utils.query_cache import query_cache
+from utils.restaurant import Restaurant
+from utils.profiles import (aload_profile, aprofile_vectors, asave_preference as asave_user_preference, load_profile,
+                            profile_vectors, save_preference as save_user_preference)
+
+# How many restaurants are ranked into the output
+RANK_LIMIT = 9
+
+# Run the router and the query formulation (+ Text Search) at the same time,
+# the query branch is cancelled as soon as the route turns out to be save_and_end
+SPECULATIVE_GRAPH = os.getenv("SPECULATIVE_GRAPH", "true").lower() == "true"
+
+# Every node as a coroutine on the AsyncPostgresStore and async clients, no executor threads held per request
+# False keeps the blocking nodes, for comparing the two under load
+ASYNC_GRAPH = os.getenv("ASYNC_GRAPH", "false").lower() == "true"
+
+# Router stream is cut here if no route has shown up, and the default route is used
+ROUTER_MAX_TOKENS = int(os.getenv("ROUTER_MAX_TOKENS", "1024"))
 
 # Custom state for the graph
 # Enables future manipulation
@@ -17,24 +42,45 @@ class State(MessagesState):
     input: str
     decision: str
     query: str
-    output: list
-    restaurants: list
-    state_token_count: int
+    # Ranked, best first
+    output: list[Restaurant]
+    # Keyed by place id, in search order
+    restaurants: dict[str, Restaurant]
+    review_vectors: np.ndarray
+    place_ids: list
+    # Summed, parallel nodes both report their tokens in the same step
+    state_token_count: Annotated[int, operator.add]
+
+
+ROUTE_JSON = re.compile(r'\{\s*"route"\s*:\s*"?(\w+)"?\s*\}')
+
+
+def parse_router_output(text: str) -> str | None:
+    '''The {"route": ...} JSON after the think block, None until it has been streamed'''
+    if "<think>" in text:
+        if "</think>" not in text:
+            return None
+        text = text.split("</think>", 1)[1]
+    match = ROUTE_JSON.search(text)
+    return match.group(0) if match else None
+
 
-def get_graph(db: ConnectPostgres):
+def parse_route(decision: str) -> str:
+    if "save" in decision:
+        return 'save'
+    elif "end" in decision:
+        return 'save_and_end'
+    else:
+        return 'no_save'
+
+
+def get_graph(db: ConnectPostgres, speculative: bool = SPECULATIVE_GRAPH, asynchronous: bool = ASYNC_GRAPH):
     
     router_llm = get_chat_model('deepseek-r1-distill-llama-70b', temperature=0)
     query_llm = get_chat_model('gemma2-9b-it', temperature=0)
 
 
-    # A small model cant handle the decision when making a tool call
-    # Currently using a model that does reasoning with <think> tags, prefer that
-    def router_model(state: State, writer: StreamWriter):
-        '''Used to decide if user input contains
-           pereferences that need to be saved'''
-        
-        input = state["input"]
-    
+    def router_messages(input: str):
         sys_prompt ='''You are a router tasked to output a route that best matches the following use cases.
     "no" is a route used for time when user requests something, but does not implicate a preference that could be saved. 
     This route is also the default route.
@@ -46,55 +92,136 @@ def get_graph(db: ConnectPostgres):
         human_msg = f'''Decide a route for this input: {input}. Output in JSON format: {{"route": **your answer**}}.
     Do not output anything else.'''
         
+        return [SystemMessage(content=sys_prompt),
+                HumanMessage(content = human_msg)]
+
+
+    def router_result(input: str, content: str, matched: bool) -> tuple[str, str | None]:
+        '''The decision from the streamed router answer, and its route label if the answer was clean'''
+        if matched:
+            result = parse_router_output(content)
+        elif "<think>" in content and "</think>" not in content:
+            # Ran out of budget while still thinking, default route
+            print(f"Router hit the token cap, defaulting: {input}")
+            result = '{"route": "no"}'
+        else:
+            # Check if llm answer contains thinking tags
+            # Hopefully it does, but needs to be parsed for the conditional to match properly
+            match = re.search(r"</think>\s*(.*)", content, re.DOTALL)
+            result = match.group(1) if match else content
+
+        # Only clean answers are used as training data
+        label = re.search(r'"route"\s*:\s*"(\w+)"', result)
+        if label and label.group(1) in ROUTES:
+            return result, label.group(1)
+        return result, None
 
-        msg = [SystemMessage(content=sys_prompt),
-               HumanMessage(content = human_msg)]
+
+    # A small model cant handle the decision when making a tool call
+    # Currently using a model that does reasoning with <think> tags, prefer that
+    def router_model(state: State, writer: StreamWriter):
+        '''Used to decide if user input contains
+           pereferences that need to be saved'''
         
+        input = state["input"]
         writer({"custom_key": "Deciding a route"})
 
-        ans = router_llm.invoke(msg)
-    
-        # Check if llm answer contains thinking tags
-        # Hopefully it does, but needs to be parsed for the conditional to match properly
-        match = re.search(r"</think>\s*(.*)", ans.content, re.DOTALL)
-        result = match.group(1) if match else ans.content
+        # Obvious inputs are decided locally, no tokens spent
+        local_route, guess, trusted = route_classifier.decide(input)
+        if local_route:
+            return {"decision": json.dumps({"route": local_route}), "state_token_count": 0}
+
+        # Stop reading as soon as the route is out, the rest of the trace is not needed
+        content, tokens, matched = stream_until(router_llm, router_messages(input),
+                                                lambda text: parse_router_output(text) is not None,
+                                                ROUTER_MAX_TOKENS)
+
+        result, label = router_result(input, content, matched)
+        if label:
+            route_classifier.record(guess, trusted, label)
+            route_classifier.log(input, label)
         
         # Should result in {"router": **answer**}
-        return {"decision": result, "state_token_count": ans.usage_metadata["total_tokens"]}
+        return {"decision": result, "state_token_count": tokens}
+
+
+    async def arouter_model(state: State, writer: StreamWriter):
+        input = state["input"]
+        writer({"custom_key": "Deciding a route"})
+
+        local_route, guess, trusted = route_classifier.decide(input)
+        if local_route:
+            return {"decision": json.dumps({"route": local_route}), "state_token_count": 0}
+
+        content, tokens, matched = await astream_until(router_llm, router_messages(input),
+                                                       lambda text: parse_router_output(text) is not None,
+                                                       ROUTER_MAX_TOKENS)
+
+        result, label = router_result(input, content, matched)
+        if label:
+            route_classifier.record(guess, trusted, label)
+            await route_classifier.alog(input, label)
+
+        return {"decision": result, "state_token_count": tokens}
 
 
     def router_conditional(state: State, config: RunnableConfig):
-        router_answer = state["decision"]
+        route = parse_route(state["decision"])
     
-        if "save" in router_answer:
+        if route == 'save':
             print(f"Saved: {state['input']}")
-            return 'save'
-        elif "end" in router_answer:
+        elif route == 'save_and_end':
             print(f"Exiting, saving manually: {state['input']}")
             save_preference(state, config)
-            return 'save_and_end'
         else:
             print(f"Did not save: {state['input']}")
-            return 'no_save'
+        return route
+
+
+    async def arouter_conditional(state: State, config: RunnableConfig):
+        route = parse_route(state["decision"])
+
+        if route == 'save':
+            print(f"Saved: {state['input']}")
+        elif route == 'save_and_end':
+            print(f"Exiting, saving manually: {state['input']}")
+            await asave_preference(state, config)
+        else:
+            print(f"Did not save: {state['input']}")
+        return route
+
+
+    def speculative_targets(route: str) -> list[str]:
+        # saver_FUNC runs next to restaurants_FUNC, save_and_end already saved and has nothing left to do
+        return {"save": ["saver_FUNC", "restaurants_FUNC"],
+                "no_save": ["restaurants_FUNC"],
+                "save_and_end": [END]}[route]
+
+
+    def speculation_conditional(state: State, config: RunnableConfig):
+        return speculative_targets(router_conditional(state, config))
+
+
+    async def aspeculation_conditional(state: State, config: RunnableConfig):
+        return speculative_targets(await arouter_conditional(state, config))
     
 
     def save_preference(state: State, config: RunnableConfig):
         ''' Use this function to save user preferences '''
 
         user_id = config["configurable"]["user_id"]
-        
-        with db.get_store() as store:
-            store.put(("users", user_id), 
-                        uuid.uuid4(), 
-                        {
-                         "preference": state['input'], 
-                        },
-                        index=["preference"])
+
+        # Raw history plus the incrementally updated profile used for ranking
+        save_user_preference(db, user_id, state['input'])
+
+
+    async def asave_preference(state: State, config: RunnableConfig):
+        user_id = config["configurable"]["user_id"]
+        await asave_user_preference(db, user_id, state['input'])
 
 
     # Makes the query from a sometimes vague user input
-    def query_formulator(state: State, writer: StreamWriter):
-        global global_token_count
+    def query_messages(input: str):
         sys_prompt = f"""
         You are a diligent restaurant recommendation query formatter.
         
@@ -108,25 +235,104 @@ def get_graph(db: ConnectPostgres):
         Output only the query, no additional explanation is needed.
         """
     
+        sys = SystemMessage(sys_prompt)
+        usr = HumanMessage(input)
+        return [sys, usr]
+
+
+    def query_formulator(state: State, writer: StreamWriter):
         writer({"custom_key": "Generating a query"})
 
         input = state["input"]
-        
-        sys = SystemMessage(sys_prompt)
-        usr = HumanMessage(input)
-    
-        answer = query_llm.invoke([sys, usr])
 
-        tokens = state["state_token_count"]
-        tokens += answer.usage_metadata["total_tokens"]
-    
-        return {"query": answer.content, "state_token_count": tokens}
-    
+        # Same or nearly the same input seen before, no LLM call and no tokens
+        cached = query_cache.get(input)
+        if cached is not None:
+            return {"query": cached, "state_token_count": 0}
+
+        answer = query_llm.invoke(query_messages(input))
+        query_cache.set(input, answer.content)
+
+        return {"query": answer.content, "state_token_count": answer.usage_metadata["total_tokens"]}
 
-    def get_restaurant_list(state: State, config: RunnableConfig, writer: StreamWriter):
+
+    async def aquery_formulator(state: State, writer: StreamWriter):
+        writer({"custom_key": "Generating a query"})
+
+        input = state["input"]
+
+        cached = await query_cache.aget(input)
+        if cached is not None:
+            return {"query": cached, "state_token_count": 0}
+
+        answer = await query_llm.ainvoke(query_messages(input))
+        await query_cache.aset(input, answer.content)
+
+        return {"query": answer.content, "state_token_count": answer.usage_metadata["total_tokens"]}
+
+
+    async def speculative_query_formulator(state: State, config: RunnableConfig, writer: StreamWriter):
+        '''Same as query_formulator, but runs alongside the router
+        Also prefetches the place IDs, Text Search with only IDs is free
+        '''
+        writer({"custom_key": "Generating a query"})
+
+        input = state["input"]
+
+        if asynchronous:
+            query = await query_cache.aget(input)
+        else:
+            query = await asyncio.to_thread(query_cache.get, input)
+        if query is not None:
+            tokens = 0
+        else:
+            answer = await query_llm.ainvoke(query_messages(input))
+            query = answer.content
+            tokens = answer.usage_metadata["total_tokens"]
+            if asynchronous:
+                await query_cache.aset(input, query)
+            else:
+                await asyncio.to_thread(query_cache.set, input, query)
+
+        try:
+            place_ids = await search_place_ids(query, config["configurable"]["location"])
+        except Exception as e:
+            # Not fatal here, restaurants_FUNC searches again and surfaces the error
+            print(f"Speculative search failed: {e}")
+            place_ids = None
+
+        return {"query": query, "place_ids": place_ids, "state_token_count": tokens}
+
+
+    async def speculative_router(state: State, config: RunnableConfig, writer: StreamWriter):
+        '''Router and query formulator side by side in one node
+        The query is cancelled as soon as the route is save_and_end, so that request ends with the router
+        and no tokens of the discarded query are counted. If the query was already done its tokens were spent anyway
+        '''
+        speculation = asyncio.create_task(speculative_query_formulator(state, config, writer))
+        try:
+            if asynchronous:
+                routed = await arouter_model(state, writer)
+            else:
+                routed = await asyncio.to_thread(router_model, state, writer)
+        except BaseException:
+            speculation.cancel()
+            raise
+
+        if parse_route(routed["decision"]) == 'save_and_end':
+            speculation.cancel()
+            return routed
+
+        speculated = await speculation
+        return {**routed, **speculated, "state_token_count": routed["state_token_count"] + speculated["state_token_count"]}
+
+
+    async def get_restaurant_list(state: State, config: RunnableConfig, writer: StreamWriter):
         '''Get a list of restaurants from Google Maps
         LLM NOT USED
         get_restaurants is a function for the actual API query, stores results in vector db (to save money)
+        Async, so the Place Details calls run concurrently instead of pinning a worker thread
+        Local-first: saved restaurants near the user are used when there are enough relevant ones
         TODO: room for more logic
         '''
         query = state["query"]
@@ -135,48 +341,88 @@ def get_graph(db: ConnectPostgres):
 
         location: dict = config["configurable"]["location"]
     
-        # gets a list of dicts containing Google Maps results, keys "name" and "reviews"
-        hits = get_restaurants(query, db, location)
+        # Enough relevant places already saved nearby, no Places API calls needed
+        if asynchronous:
+            hits = await afind_local_restaurants(query, db, location)
+        else:
+            hits = await asyncio.to_thread(find_local_restaurants, query, db, location)
+
+        # Each place goes out to the client as soon as it is resolved, ranking reorders them later
+        def push(place: Restaurant):
+            writer({"candidates": {place.id: place.to_payload()}})
+
+        # Restaurants keyed by place id
+        if hits is None:
+            hits = await get_restaurants(query, db, location, place_ids=state.get("place_ids"), on_place=push)
+        else:
+            writer({"candidates": {id: place.to_payload() for id, place in hits.items()}})
     
         hits = remove_duplicates(hits)
     
         return {"restaurants": hits}
 
 
+    def apply_preferences(restaurant_list: list[Restaurant], profile: dict, pref_vectors: np.ndarray,
+                          review_vectors: np.ndarray) -> list[Restaurant]:
+        user_preferences = profile["preferences"]
+
+        # Go through every user preference. If a preference is found that forbids use, that restaurant gets a 'pop'
+        # in the state
+        # If no forbiddings are found, a restaurant gets either 'boost' or 'none' tag in state
+        
+        # elements get 'boost' note here if strong match with preferences, either 'none'
+        restaurant_list = check_preference_score(restaurant_list, review_vectors, pref_vectors)
+    
+        # All names against all negative preferences in one native call
+        pop_mask = negative_preference_mask([restaurant.name for restaurant in restaurant_list],
+                                            [pref["target"] for pref in user_preferences],
+                                            [pref["negative"] for pref in user_preferences])
+        for restaurant, pop in zip(restaurant_list, pop_mask):
+            if pop:
+                restaurant.pref_note = 'pop'
+        return restaurant_list
+
+
     def preference_checker(state: State, config: RunnableConfig, writer: StreamWriter):
         '''Add information about preferences to the restaurant list
-        Vector search for selecting which preferences should increase the value of the restaurant.
+        Similarity matrix of preference and review vectors for selecting which preferences should increase the value of the restaurant.
         A stupid function is used for selecting non-preferred restaurants
-        with a list of negative words and fuzzywuzzy matching score.
-        Outputs a list of restaurants added with "pref_note" key
+        with a list of negative words and rapidfuzz matching score, batched over all names and preferences.
+        Sets pref_note on the restaurants, review vectors go to the state in restaurant order
         '''
         
-        restaurant_list = state["restaurants"]
+        restaurants = state["restaurants"]
+        restaurant_list = list(restaurants.values())
         user_id = config["configurable"]["user_id"]
 
         writer({"custom_key": "Calculating user preferences"})
 
-        with db.get_store() as store:
-            user_preferences = store.search(("users", user_id))
-    
-    
-        # Go through every user preference. If a preference is found that forbids use, that restaurant gets a 'pop'
-        # in the state
-        # If no forbiddings are found, a restaurant gets either 'boost' or 'none' tag in state
-        
-        # elements get 'boost' note here if strong match with preferences, either 'none'
-        restaurant_list = check_preference_score(restaurant_list, user_id, user_preferences, db)
-    
-        # restaurant: {"name": Restaurant Name, "reviews": ["Review 1: abcd, Review 2: xyzd"]}
-        for restaurant in restaurant_list:
-               
-                for pref in user_preferences:
-                    neg = check_preference_negative(restaurant['name'], pref.value['preference'])
-                    if neg == 'pop':
-                        restaurant["pref_note"] = 'pop'
+        # One small record with negation already worked out at save time, its vectors in one store_vectors read
+        profile = load_profile(db, user_id)
+        pref_vectors = profile_vectors(db, user_id, profile)
+        review_vectors = get_review_vectors(db, restaurant_list)
+        apply_preferences(restaurant_list, profile, pref_vectors, review_vectors)
+
+        return {'restaurants': restaurants, 'review_vectors': review_vectors}
+
 
-                
-        return {'restaurants': restaurant_list}
+    async def apreference_checker(state: State, config: RunnableConfig, writer: StreamWriter):
+        restaurants = state["restaurants"]
+        restaurant_list = list(restaurants.values())
+        user_id = config["configurable"]["user_id"]
+
+        writer({"custom_key": "Calculating user preferences"})
+
+        async def load_preferences():
+            profile = await aload_profile(db, user_id)
+            return profile, await aprofile_vectors(db, user_id, profile)
+
+        # Independent reads, both in flight at once
+        (profile, pref_vectors), review_vectors = await asyncio.gather(load_preferences(),
+                                                                       aget_review_vectors(db, restaurant_list))
+        apply_preferences(restaurant_list, profile, pref_vectors, review_vectors)
+
+        return {'restaurants': restaurants, 'review_vectors': review_vectors}
 
 
     def sort_restaurants(state: State, config: RunnableConfig, writer: StreamWriter):
@@ -184,91 +430,96 @@ def get_graph(db: ConnectPostgres):
         Add preference information by decreasing score of preferred and increasing non-preferred 
         (smaller is better)
         LLM NOT USED
-        Outputs a sorted list of restaurant Documents, first (lowest score) is best
+        Ranked in memory: review vectors come from the stored restaurant records,
+        the input is embedded once and scored with numpy, nothing is written to the store
+        Outputs the top restaurants with their score set, first is best
         '''
-        raw_result = state["restaurants"]
-        user_id = config["configurable"]["user_id"]
+        raw_result = list(state["restaurants"].values())
         input = state["input"] 
     
         writer({"custom_key": "Ranking the restaurants"})
-        
 
-        # reviews already indexed in previous step
-        for restaurant in raw_result:
-            with db.get_store() as store:
-                store.put(namespace=("rank_restaurants", user_id), 
-                          key=restaurant["name"], 
-                          value={
-                           "pref_note": restaurant["pref_note"]
-                          }
-                )
-                
-
-        # score_item:
-        # Item(namespace=['rank_restaurants', '1'], 
-        #      key='Rice Story', 
-        #      value={'reviews': ['Review 1: Service was fast and friendly, '], 'pref_note': 'none'},
-        #      created_at='2025-03-16T18:42:23.348161+00:00', updated_at='2025-03-16T18:42:23.348161+00:00', 
-        #      score=0.35495079621526004)
-        with db.get_store() as store:
-            score_items = store.search(("rank_restaurants", user_id), query=input, limit=9)
-
-
-        # Delete, needs a way to filter rather than delete to save embeddings calls
-        for restaurant in raw_result:
-            with db.get_store() as store:
-                store.delete(namespace=("rank_restaurants", user_id), 
-                             key=restaurant["name"]
-                )
+        # Read once in preference_checker, rows follow the restaurant list
+        review_vectors = state.get("review_vectors")
+        if review_vectors is None or len(review_vectors) != len(raw_result):
+            review_vectors = get_review_vectors(db, raw_result)
+        query_vector = db.embeddings.embed_query(input)
 
-        
-        # ('iizip Korean Restaurant (iizip & BBQ)', 0.5731853032112122)
-        updated_tuple_list = []
-        for i in score_items:
-            name = i.key 
-            score = i.score
+        return {'output': rank(raw_result, review_vectors, query_vector)}
 
-            match = next((item for item in raw_result if item["name"] == name), None)
-    
-            if match:
-                rating = match["rating"]
-                delivery = match["delivery"]
-                maps_uri = match["maps_uri"]
-                photo = match["photo"]
-
-            # using cosine similarity, check for the need to add or subtract based on the metric
-            if i.value["pref_note"] == "boost":
-                score += 0.04 
-            if i.value["pref_note"] == "pop":
-                score -= 0.06
-            updated_tuple_list.append((name, score, rating, delivery, maps_uri, photo))
-    
-        # reverse means ascending, based on the similarity metric
-        sorted_tuple_list = sorted(updated_tuple_list, key=lambda x: x[1], reverse=True)
 
-        return {'output': sorted_tuple_list}
+    async def asort_restaurants(state: State, config: RunnableConfig, writer: StreamWriter):
+        raw_result = list(state["restaurants"].values())
+        input = state["input"]
+
+        writer({"custom_key": "Ranking the restaurants"})
+
+        review_vectors = state.get("review_vectors")
+        if review_vectors is None or len(review_vectors) != len(raw_result):
+            review_vectors = await aget_review_vectors(db, raw_result)
+        query_vector = await db.embeddings.aembed_query(input)
+
+        return {'output': rank(raw_result, review_vectors, query_vector)}
+
+
+    def rank(raw_result: list[Restaurant], review_vectors: np.ndarray, query_vector: list[float]) -> list[Restaurant]:
+        scores = cosine_similarity(np.asarray(query_vector, dtype=np.float32), review_vectors)[0]
+
+        # using cosine similarity, check for the need to add or subtract based on the metric
+        pref_notes = np.array([restaurant.pref_note for restaurant in raw_result])
+        scores = scores + 0.04 * (pref_notes == "boost") - 0.06 * (pref_notes == "pop")
+
+        # Same top 9 the store search used to return
+        # reverse means ascending, based on the similarity metric
+        top_k = np.argsort(-scores, kind="stable")[:RANK_LIMIT]
+
+        ranked = []
+        for i in top_k:
+            restaurant = raw_result[i]
+            restaurant.score = float(scores[i])
+            ranked.append(restaurant)
+        return ranked
     
     workflow = StateGraph(State)
 
     # Define the two nodes we will cycle between
-    workflow.add_node("router_LLM", router_model)
-    workflow.add_node("saver_FUNC", save_preference)
-    workflow.add_node("query_LLM", query_formulator)
+    if asynchronous:
+        route = arouter_conditional
+        workflow.add_node("saver_FUNC", asave_preference)
+        workflow.add_node("preferences_FUNC", apreference_checker)
+        workflow.add_node("sort_FUNC", asort_restaurants)
+    else:
+        route = router_conditional
+        workflow.add_node("saver_FUNC", save_preference)
+        workflow.add_node("preferences_FUNC", preference_checker)
+        workflow.add_node("sort_FUNC", sort_restaurants)
     workflow.add_node("restaurants_FUNC", get_restaurant_list)
-    workflow.add_node("preferences_FUNC", preference_checker)
-    workflow.add_node("sort_FUNC", sort_restaurants)
-    
-    workflow.add_edge(START, "router_LLM")
-    workflow.add_conditional_edges("router_LLM", 
-                                   router_conditional, 
-                                   {
-                                       "save": "saver_FUNC",
-                                       "no_save": "query_LLM",
-                                       "save_and_end": END
-                                   })
-    
-    workflow.add_edge("saver_FUNC", "query_LLM")
-    workflow.add_edge("query_LLM", "restaurants_FUNC")
+
+    if speculative:
+        # The router is off the critical path, the query and Text Search run next to it in the same node
+        # and are cancelled on save_and_end. saver_FUNC runs next to restaurants_FUNC
+        workflow.add_node("router_LLM", speculative_router)
+
+        workflow.add_edge(START, "router_LLM")
+        workflow.add_conditional_edges("router_LLM",
+                                       aspeculation_conditional if asynchronous else speculation_conditional,
+                                       ["saver_FUNC", "restaurants_FUNC", END])
+        workflow.add_edge("saver_FUNC", END)
+    else:
+        workflow.add_node("router_LLM", arouter_model if asynchronous else router_model)
+        workflow.add_node("query_LLM", aquery_formulator if asynchronous else query_formulator)
+
+        workflow.add_edge(START, "router_LLM")
+        workflow.add_conditional_edges("router_LLM", 
+                                       route, 
+                                       {
+                                           "save": "saver_FUNC",
+                                           "no_save": "query_LLM",
+                                           "save_and_end": END
+                                       })
+        workflow.add_edge("saver_FUNC", "query_LLM")
+        workflow.add_edge("query_LLM", "restaurants_FUNC")
+
     workflow.add_edge("restaurants_FUNC", "preferences_FUNC")
     workflow.add_edge("preferences_FUNC", "sort_FUNC")
     workflow.add_edge("sort_FUNC", END)
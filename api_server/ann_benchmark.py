@@ -0,0 +1,190 @@
+"""
+Recall and latency of the pgvector ANN indexes at different table sizes.
+
+Loads clustered synthetic unit vectors into a scratch table, computes the exact top k of every
+query with a sequential scan, then builds each index kind the same way migrate_ann_index() does
+and reports recall@k and p50/p99 latency for every ef_search / probes value.
+
+    python ann_benchmark.py --sizes 10000 100000 1000000 --kinds hnsw ivfflat \
+        --ef-search 10 20 40 80 160 --probes 1 5 10 20 40
+
+Uses the POSTGRES_* connection settings of the API. The scratch table is dropped at the end unless --keep.
+"""
+from pgvector.psycopg import register_vector # type: ignore
+from psycopg.rows import dict_row # type: ignore
+from psycopg import sql # type: ignore
+import numpy as np # type: ignore
+import argparse
+import psycopg # type: ignore
+import json
+import math
+import time
+
+from utils.db_client import (ANN_HNSW_EF_CONSTRUCTION, ANN_HNSW_M, ann_search_settings,
+                             create_ann_index, index_definition, postgres_url)
+
+INDEX_NAME = "ann_benchmark_idx"
+# Rows generated and copied per round, keeps memory flat at a million rows
+CHUNK_SIZE = 10000
+
+
+def ivfflat_lists(rows: int) -> int:
+    """pgvector's suggestion, rows / 1000 up to a million rows, sqrt(rows) above."""
+    if rows <= 1_000_000:
+        return max(10, rows // 1000)
+    return int(math.sqrt(rows))
+
+
+def percentile(values: list[float], p: float) -> float:
+    return float(np.percentile(values, p)) if values else 0.0
+
+
+class VectorSource:
+    """Unit vectors around random cluster centers, embeddings of real text are clustered too."""
+
+    def __init__(self, dims: int, clusters: int, spread: float, seed: int):
+        self.rng = np.random.default_rng(seed)
+        self.dims = dims
+        self.spread = spread
+        self.centers = self._normalize(self.rng.standard_normal((clusters, dims)))
+
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+    def sample(self, n: int) -> np.ndarray:
+        centers = self.centers[self.rng.integers(0, len(self.centers), n)]
+        noise = self.rng.standard_normal((n, self.dims)) * self.spread / math.sqrt(self.dims)
+        return self._normalize(centers + noise)
+
+
+def load_table(conn, table: str, rows: int, source: VectorSource):
+    """Fresh unlogged table with `rows` vectors, binary COPY in chunks."""
+    conn.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table)))
+    conn.execute(sql.SQL("CREATE UNLOGGED TABLE {} (id int PRIMARY KEY, embedding vector({}))").format(
+        sql.Identifier(table), sql.Literal(source.dims)))
+
+    started = time.perf_counter()
+    copy_sql = sql.SQL("COPY {} (id, embedding) FROM STDIN WITH (FORMAT BINARY)").format(sql.Identifier(table))
+    with conn.cursor().copy(copy_sql) as copy:
+        copy.set_types(["int4", "vector"])
+        for offset in range(0, rows, CHUNK_SIZE):
+            for i, vector in enumerate(source.sample(min(CHUNK_SIZE, rows - offset)), offset):
+                copy.write_row((i, vector))
+    conn.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+    print(f"Loaded {rows} rows in {time.perf_counter() - started:.1f}s")
+
+
+def run_queries(conn, table: str, queries: np.ndarray, k: int, settings: list) -> tuple[list[list[int]], list[float]]:
+    """Top k ids of every query and the latency of each in ms, settings apply to these queries only."""
+    query = sql.SQL("SELECT id FROM {} ORDER BY embedding <=> %s LIMIT %s").format(sql.Identifier(table))
+    results = []
+    latencies = []
+    with conn.transaction():
+        for statement in settings:
+            conn.execute(statement)
+        # Untimed pass to get the index pages into the buffer cache
+        for vector in queries[:10]:
+            conn.execute(query, (vector, k)).fetchall()
+        for vector in queries:
+            started = time.perf_counter()
+            rows = conn.execute(query, (vector, k)).fetchall()
+            latencies.append((time.perf_counter() - started) * 1000)
+            results.append([row["id"] for row in rows])
+    return results, latencies
+
+
+def recall(results: list[list[int]], exact: list[list[int]], k: int) -> float:
+    return sum(len(set(found) & set(truth)) for found, truth in zip(results, exact)) / (k * len(exact))
+
+
+def report(row: dict):
+    print(f"{row['rows']:>9} | {row['kind']:<8} | {row['setting']:<16} | "
+          f"recall@{row['k']} {row['recall']:.4f} | p50 {row['p50_ms']:8.2f} ms | p99 {row['p99_ms']:8.2f} ms")
+
+
+def benchmark_size(conn, args, rows: int) -> list[dict]:
+    source = VectorSource(args.dims, args.clusters, args.spread, args.seed)
+    load_table(conn, args.table, rows, source)
+    queries = source.sample(args.queries)
+
+    results = []
+
+    # Ground truth, no index on the table yet and index scans disabled anyway
+    exact, latencies = run_queries(conn, args.table, queries, args.k, [sql.SQL("SET LOCAL enable_indexscan = off")])
+    results.append({"rows": rows, "kind": "flat", "setting": "exact", "k": args.k, "recall": 1.0,
+                    "p50_ms": percentile(latencies, 50), "p99_ms": percentile(latencies, 99)})
+    report(results[-1])
+
+    for kind in args.kinds:
+        if kind == "hnsw":
+            params = {"m": args.m, "ef_construction": args.ef_construction}
+            sweep = [(f"ef_search={ef}", ann_search_settings(ef_search=ef, local=True)) for ef in args.ef_search]
+        else:
+            params = {"lists": args.lists or ivfflat_lists(rows)}
+            sweep = [(f"probes={probes}", ann_search_settings(probes=probes, local=True)) for probes in args.probes]
+
+        started = time.perf_counter()
+        create_ann_index(conn, args.table, INDEX_NAME, kind, params)
+        build_seconds = time.perf_counter() - started
+        index_bytes = conn.execute("SELECT pg_relation_size(%s::regclass) AS size", (INDEX_NAME,)).fetchone()["size"]
+        print(f"Built {index_definition(conn, INDEX_NAME)} in {build_seconds:.1f}s, {index_bytes / 2**20:.1f} MiB")
+
+        for setting, statements in sweep:
+            found, latencies = run_queries(conn, args.table, queries, args.k, statements)
+            results.append({"rows": rows, "kind": kind, "params": params, "setting": setting, "k": args.k,
+                            "recall": recall(found, exact, args.k),
+                            "p50_ms": percentile(latencies, 50), "p99_ms": percentile(latencies, 99),
+                            "build_s": build_seconds, "index_mib": index_bytes / 2**20})
+            report(results[-1])
+
+        conn.execute(sql.SQL("DROP INDEX {}").format(sql.Identifier(INDEX_NAME)))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k and latency of pgvector HNSW / IVFFlat against exact search.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--dims", type=int, default=768, help="Same as the store's embeddings by default")
+    parser.add_argument("--clusters", type=int, default=100)
+    parser.add_argument("--spread", type=float, default=1.0, help="Noise around the cluster centers, higher is harder")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--kinds", nargs="+", choices=["hnsw", "ivfflat"], default=["hnsw", "ivfflat"])
+    parser.add_argument("--m", type=int, default=ANN_HNSW_M)
+    parser.add_argument("--ef-construction", type=int, default=ANN_HNSW_EF_CONSTRUCTION)
+    parser.add_argument("--lists", type=int, help="IVFFlat lists, defaults to pgvector's suggestion for the size")
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[10, 20, 40, 80, 160])
+    parser.add_argument("--probes", type=int, nargs="+", default=[1, 5, 10, 20, 40])
+    parser.add_argument("--maintenance-work-mem", default="1GB", help="HNSW builds are much slower once the graph spills")
+    parser.add_argument("--table", default="ann_benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch table")
+    args = parser.parse_args()
+
+    # Autocommit, the index builds run CONCURRENTLY like in the API
+    # Dict rows like the API pools, index_definition reads columns by name
+    with psycopg.connect(postgres_url(), autocommit=True, row_factory=dict_row) as conn:
+        conn.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        register_vector(conn)
+        conn.execute(sql.SQL("SET maintenance_work_mem = {}").format(sql.Literal(args.maintenance_work_mem)))
+
+        results = []
+        try:
+            for rows in args.sizes:
+                results.extend(benchmark_size(conn, args, rows))
+        finally:
+            if not args.keep:
+                conn.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(args.table)))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,10 @@
 from fastapi import FastAPI, APIRouter, Depends, HTTPException, BackgroundTasks # type: ignore
 from fastapi.middleware.cors import CORSMiddleware # type: ignore
-from fastapi.responses import StreamingResponse # type: ignore
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse # type: ignore
 
 import uvicorn # type: ignore
 
-from pydantic import BaseModel # type: ignore
+from pydantic import BaseModel, Field # type: ignore
 from typing import AsyncGenerator
 
 from sqlalchemy import Column, Integer, String, Boolean # type: ignore    # type: ignore
@@ -14,15 +14,27 @@ import os
 import re
 import json
 import asyncio
-
-from langchain_google_genai import GoogleGenerativeAIEmbeddings # type: ignore 
+import multiprocessing
+import signal
+import sys
 
 import utils.auth as auth
 import utils.emailer as emailer
-from utils.db_client import ConnectPostgres
+import utils.maps as maps
+from utils.route_classifier import route_classifier
+from utils.query_cache import query_cache
 from utils.validators import validate_captcha
 from utils.errors import RateLimitError
-from ai import get_graph
+from utils.search_cache import geo_cell, normalize_query
+from utils.singleflight import SharedStream
+from utils.startup import SCHEMA_VERSION, mark_schema, migration_lock, schema_current, startup
+# langchain, langgraph, the Google client and ai.py are imported by warm_up(), they take seconds to load.
+# numpy (query cache, router), SQLAlchemy (User model) and psycopg still load with this module
+
+# Worker processes run this file as their main module before uvicorn imports "app:app",
+# alias it so the models and routes are only declared once per process
+if __name__ in ("__main__", "__mp_main__"):
+    sys.modules.setdefault("app", sys.modules[__name__])
 
 
 
@@ -33,9 +45,14 @@ from ai import get_graph
 # Pydantic requests and responses
 
 # For generation
+class Location(BaseModel):
+    lat: float = Field(ge=-90, le=90)
+    lon: float = Field(ge=-180, le=180)
+
 class TextRequest(BaseModel):
     input: str
-    location: dict
+    # Validated here, a missing or bad coordinate is a 422 before anything runs
+    location: Location
 
 # For authentication
 
@@ -82,70 +99,340 @@ app.add_middleware(
 # langgraph CompiledGraph
 graph = None
 
+# Running generate pipelines by (user id, normalized input, location cell)
+pipelines: dict[tuple, SharedStream] = {}
+
+# Pooled Postgres connection, shared by every request
+db = None
+
 # CryptContext for password hashing
 pwd_context = auth.get_crypt_context()
 
 DOMAIN = os.getenv("DOMAIN")
 
+# Status updates closer together than this are merged, only the latest one is sent
+SSE_STATUS_INTERVAL = float(os.getenv("SSE_STATUS_INTERVAL", "0.25"))
+# Comment line sent when nothing else has been sent for this long, keeps proxies from closing the stream
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "10"))
 
 
-@app.on_event("startup")
-async def load_models():
-    global graph
+def sse(data: dict) -> str:
+    return f"data: {json.dumps(data)}\n\n"
+
+
+# Serve right away and warm up in the background, /api/ready answers 503 until warm
+BACKGROUND_STARTUP = os.getenv("BACKGROUND_STARTUP", "false").lower() == "true"
+# Run the setup() migrations even when the schema version says they already ran
+FORCE_MIGRATIONS = os.getenv("FORCE_MIGRATIONS", "false").lower() == "true"
+
+# warm_up() running in the background
+warmup_task = None
+
+# Comma separated emails allowed to read /api/stats, nobody when unset
+STATS_USERS = {email.strip().lower() for email in os.getenv("STATS_USERS", "").split(",") if email.strip()}
+
+# Server processes, "auto" for one per core. Every worker imports this module and runs load_models()
+# itself, so connection pools and the compiled graph are never shared between processes
+WEB_CONCURRENCY = os.getenv("WEB_CONCURRENCY", "1")
+# Seconds a stopping worker lets open requests (SSE streams) finish before cancelling them
+GRACEFUL_SHUTDOWN_TIMEOUT = int(os.getenv("GRACEFUL_SHUTDOWN_TIMEOUT", "30"))
+
+
+def worker_count() -> int:
+    if WEB_CONCURRENCY == "auto":
+        return os.cpu_count() or 1
+    return max(int(WEB_CONCURRENCY), 1)
+
+
+def heavy_imports():
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings # type: ignore
+    from utils.db_client import ConnectPostgres
+    from utils.embeddings import CachedEmbeddings
+    import ai
+    return GoogleGenerativeAIEmbeddings, ConnectPostgres, CachedEmbeddings, ai
+
+
+def run_migrations(db, embeddings) -> bool:
+    """
+    Every setup() migration, skipped when the schema version in Postgres is already current.
+    The ANN index settings are part of the version, changing them migrates the index.
+
+    Returns:
+        bool: Whether the migrations ran
+    """
+    version = f"{SCHEMA_VERSION}|{db.ann_kind}|{json.dumps(db.ann_params, sort_keys=True)}"
+    if not FORCE_MIGRATIONS and schema_current(db.pool, "api", version):
+        return False
+
+    with migration_lock(db.pool):
+        # Another worker may have finished them while this one waited for the lock
+        if not FORCE_MIGRATIONS and schema_current(db.pool, "api", version):
+            return False
+
+        auth.Base.metadata.create_all(bind=auth.engine)
+        with db.get_store() as store:
+            store.setup()
+        db.setup_geo_index()
+        db.migrate_ann_index()
+        embeddings.setup()
+        maps.search_cache.setup()
+        maps.photo_cache.setup()
+        route_classifier.setup()
+        print(f"Backfilled fetched_at of {maps.backfill_fetched_at(db)} saved restaurants")
+
+        mark_schema(db.pool, "api", version)
+    return True
+
+
+async def warm_up():
+    global graph, db
+
+    # Connections inherited through a fork (e.g. a preloading process manager) stay with the parent
+    auth.engine.dispose(close=False)
+
+    with startup.phase("imports"):
+        GoogleGenerativeAIEmbeddings, ConnectPostgres, CachedEmbeddings, ai = await asyncio.to_thread(heavy_imports)
 
     # Load embeddings
     EMBED_MODEL_NAME = "models/text-embedding-004"
 
     # This is from google's docs. If unsure, use len(embeddings.embed_query("hello world"))
     DIMS = 768
-    embeddings = GoogleGenerativeAIEmbeddings(model=EMBED_MODEL_NAME)
 
-    # Postgres
-    db = ConnectPostgres(embeddings, DIMS)
+    with startup.phase("pools"):
+        # Cached by content hash, repeat reviews, preferences and inputs skip the API
+        embeddings = CachedEmbeddings(GoogleGenerativeAIEmbeddings(model=EMBED_MODEL_NAME), EMBED_MODEL_NAME)
+
+        # Postgres, wait for the pool's first connections so requests don't pay for them
+        db = await asyncio.to_thread(ConnectPostgres, embeddings, DIMS)
+        await asyncio.to_thread(db.pool.wait)
+        # The async graph gets its own AsyncConnectionPool, opened here inside the serving loop
+        if ai.ASYNC_GRAPH:
+            await db.aopen()
+            await db.async_pool.wait()
+        embeddings.bind(db.cache_pool, db.async_cache_pool)
+        maps.search_cache.bind(db.pool, db.async_pool)
+        maps.photo_cache.bind(db.pool, db.async_pool)
+        route_classifier.bind(db.pool, db.async_pool)
+        query_cache.bind(embeddings)
+
+    with startup.phase("migrations"):
+        migrated = await asyncio.to_thread(run_migrations, db, embeddings)
+        print("Ran migrations" if migrated else "Schema is current, skipped migrations")
+
+    with startup.phase("router"):
+        await asyncio.to_thread(route_classifier.load)
+
+    with startup.phase("graph"):
+        graph = await asyncio.to_thread(ai.get_graph, db)
 
-    with db.get_store() as store:
-        store.setup()
+    maps.place_refresher.start(db)
+    maps.place_writer.start(db)
 
-    graph = get_graph(db)
-    print("\nLoaded embedding model, FAISS and Postgres stores.\n")
+    startup.done()
+
+
+@app.on_event("startup")
+async def load_models():
+    global warmup_task
+
+    async def run():
+        try:
+            await warm_up()
+        except Exception as e:
+            startup.fail(e)
+            if not BACKGROUND_STARTUP:
+                # uvicorn exits on a failed startup, the supervisor starts the worker again
+                raise
+            # A worker that never warms up would answer 503 forever, stop it so uvicorn / Docker restarts it
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    if BACKGROUND_STARTUP:
+        warmup_task = asyncio.create_task(run())
+    else:
+        await run()
+
+
+@app.on_event("shutdown")
+async def close_clients():
+    if warmup_task is not None and not warmup_task.done():
+        warmup_task.cancel()
+    await maps.place_refresher.stop()
+    # Pending places are saved before the pool goes away
+    await maps.place_writer.close()
+    await maps.close_client()
+    if db:
+        await db.aclose()
+
+
+# Liveness, answers as soon as the process serves
+@api_router.get("/health")
+async def health():
+    return {"status": "ok", "startup": startup.state}
+
+
+# Readiness, only once pools, migrations and the graph are warm. Public like /health, so no details
+@api_router.get("/ready")
+async def ready():
+    status_code = 200 if startup.ready else 503
+    return JSONResponse({"ready": startup.ready, "startup": startup.state}, status_code=status_code)
+
+
+# Internal counters, errors and pool sizes, only for the STATS_USERS accounts
+@api_router.get("/stats")
+async def stats(user_email: str = Depends(auth.get_current_user)):
+    if user_email.lower() not in STATS_USERS:
+        raise HTTPException(status_code=403, detail="Not allowed")
+    if not db:
+        return {"startup": startup.stats()}
+    return {"startup": startup.stats(),
+            "postgres_pool": db.stats(),
+            "embedding_cache": db.embeddings.stats(),
+            "search_cache": maps.search_cache.stats(),
+            "photo_cache": maps.photo_cache.stats(),
+            "place_refresher": maps.place_refresher.stats(),
+            "place_writer": maps.place_writer.stats(),
+            "details_flight": maps.details_flight.stats(),
+            "pipelines": len(pipelines),
+            "router": route_classifier.stats(),
+            "query_cache": query_cache.stats()}
+
+
+# Resolved URIs are not permanent, let browsers keep the redirect for a day at most
+PHOTO_REDIRECT_MAX_AGE = int(os.getenv("PHOTO_REDIRECT_MAX_AGE", "86400"))
+
+
+# No auth, <img> tags can't send the token. Resolves signed photo references from our own URLs
+# (the place may not be saved yet) and saved places, see maps.resolve_photo
+@api_router.get("/photo/{place_id}")
+async def photo(place_id: str, ref: str | None = None, sig: str | None = None):
+    if ref is not None:
+        if sig is None or not maps.verify_photo_ref(place_id, ref, sig):
+            raise HTTPException(status_code=403, detail="Invalid photo reference")
+        resolver = lambda id: maps.fetch_photo_uri(ref)
+    else:
+        resolver = lambda id: maps.resolve_photo(db, id)
+
+    try:
+        photo_uri = await maps.photo_cache.get(place_id, resolver)
+    except RateLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+    if photo_uri is None:
+        raise HTTPException(status_code=404, detail="Photo not found")
+
+    return RedirectResponse(photo_uri, status_code=302,
+                            headers={"Cache-Control": f"public, max-age={PHOTO_REDIRECT_MAX_AGE}"})
+
+
+def get_user(email: str) -> User | None:
+    with auth.SessionLocal() as session:
+        user = session.query(User).filter(User.email == email).first()
+        if user is not None:
+            # Only plain columns are read after the session closes
+            session.expunge(user)
+        return user
 
 
 @api_router.post("/generate")
 async def generate_answer(user_input: TextRequest, 
-                          user_email: str = Depends(auth.get_current_user),
-                          user_db: Session = Depends(auth.get_db)):
+                          user_email: str = Depends(auth.get_current_user)):
     
+    if not startup.ready:
+        raise HTTPException(status_code=503, detail="Warming up, try again shortly", headers={"Retry-After": "5"})
+
     input = user_input.input
     
-    user = user_db.query(User).filter(User.email == user_email).first()
+    # Own short session, a get_db dependency would hold its connection until the stream ends
+    user = await asyncio.to_thread(get_user, user_email)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Unknown user")
 
 
     config = {"configurable": {
                               
                               "user_id": str(user.id),
-                              "location": user_input.location,
+                              "location": user_input.location.model_dump(),
                               }
     } 
 
    
+    # Double clicks and retries attach to the pipeline already running for the same request
+    lat_cell, lon_cell = geo_cell(user_input.location.lat, user_input.location.lon)
+    pipeline_key = (user.id, normalize_query(input), lat_cell, lon_cell)
+
     # Create async generator for streaming custom updates from nodes
+    # The graph runs in its own task and feeds a queue, so heartbeats and coalesced
+    # status updates can be sent while a node is still working
     async def event_stream() -> AsyncGenerator[str, None]:
-        chunks = []
+        def forget(done: SharedStream):
+            if pipelines.get(pipeline_key) is done:
+                del pipelines[pipeline_key]
+
+        pipeline = pipelines.get(pipeline_key)
+        if pipeline is None:
+            pipeline = SharedStream(graph.astream(input={"input": input}, config=config, stream_mode=['values', 'custom']),
+                                    on_done=forget)
+            pipelines[pipeline_key] = pipeline
+        else:
+            print(f"Attached to a running pipeline: {input}")
+
+        # Starts with everything the pipeline has produced so far
+        queue = pipeline.subscribe()
+        loop = asyncio.get_running_loop()
+
+        last_values = {}
+        pending_status = None
+        last_status_at = 0.0
+        last_sent_at = loop.time()
+
         try:
-            async for metadata, chunk in graph.astream(input={"input": input}, config=config, stream_mode=['values', 'custom']):
+            while True:
+                now = loop.time()
+                timeout = SSE_HEARTBEAT - (now - last_sent_at)
+                if pending_status:
+                    timeout = min(timeout, SSE_STATUS_INTERVAL - (now - last_status_at))
+
+                try:
+                    item = await asyncio.wait_for(queue.get(), max(timeout, 0))
+                except asyncio.TimeoutError:
+                    now = loop.time()
+                    if pending_status:
+                        yield sse(pending_status)
+                        pending_status = None
+                        last_status_at = now
+                    else:
+                        yield ": keep-alive\n\n"
+                    last_sent_at = now
+                    continue
+
+                if item is SharedStream.END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                metadata, chunk = item
+                now = loop.time()
+
                 if metadata == 'values':
-                    chunks.append(chunk)
-                if metadata == 'custom':
+                    last_values = chunk
+
+                elif "candidates" in chunk:
+                    # Resolved restaurants in search order, ranked later by the "complete" update
+                    yield sse({"status": "candidates", "output": chunk["candidates"]})
+                    last_sent_at = now
+
+                elif "custom_key" in chunk:
                     update = {
                         "status": "processing",
                         "output": chunk["custom_key"]
-            
                     }
-                    
-                    await asyncio.sleep(0.5)  # Small delay to prevent flooding
-                    
-                    yield f"data: {json.dumps(update)}\n\n"
-                    
+                    if now - last_status_at >= SSE_STATUS_INTERVAL:
+                        yield sse(update)
+                        last_status_at = last_sent_at = now
+                    else:
+                        pending_status = update
+
         # raise RateLimitError('Rate limits hit', 'Google Maps API')
         except RateLimitError as e:
             update = {
@@ -153,35 +440,26 @@ async def generate_answer(user_input: TextRequest,
                         "output": str(e)
             
                     }
-            yield f"data: {json.dumps(update)}\n\n"     
-
+            yield sse(update)
+            return
+        finally:
+            # The pipeline is stopped once no client is listening to it
+            pipeline.unsubscribe(queue)
 
         # Final output
     
-        if "output" in chunks[-1].keys():
-            # List of Documents
-            output_list = chunks[-1]["output"]
+        if "output" in last_values.keys():
+            # Ranked Restaurants, best first
+            output_list = last_values["output"]
     
-            result = {}
             final_update = {
                 "status": "complete",
-                "output": result
+                "output": {str(i): restaurant.to_payload() for i, restaurant in enumerate(output_list)}
             }
-
-            
-            for i, output in enumerate(output_list):
-                output_data = {}
-                # (name, score, rating, delivery, maps_uri, photo)
-                output_data["name"] = output[0]
-                output_data["rating"] = output[2]
-                output_data["delivery"] = output[3]
-                output_data["maps_uri"] = output[4]
-                output_data["photo"] = output[5]
-                final_update["output"][str(i)] = output_data
     
     
-        elif "decision" in chunks[-1].keys():
-            if "end" in chunks[-1]["decision"]:
+        elif "decision" in last_values.keys():
+            if "end" in last_values["decision"]:
                 final_update = {
                         "status": "end",
                         "output": 'Saved a liking'
@@ -192,9 +470,10 @@ async def generate_answer(user_input: TextRequest,
                     "output": "Should probably raise an error"
                 }
     
-        yield f"data: {json.dumps(final_update)}\n\n"
+        yield sse(final_update)
     
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @api_router.post("/register")
@@ -348,7 +627,18 @@ async def contact(user: ContactForm):
 
 app.include_router(api_router)
 
-auth.Base.metadata.create_all(bind=auth.engine)
-
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
+    # Workers are spawned, in the PyInstaller binary they start by re-running it and are handed off here
+    multiprocessing.freeze_support()
+
+    workers = worker_count()
+    # Inherited by the workers, budgets meant for the whole server are split between them
+    os.environ["API_WORKERS"] = str(workers)
+
+    if workers > 1:
+        # SIGHUP restarts the workers one at a time, each drains its open requests before exiting
+        # and the new one only takes connections once load_models() is done
+        uvicorn.run("app:app", host="0.0.0.0", port=8080, workers=workers,
+                    timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_TIMEOUT)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8080, timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_TIMEOUT)
\ No newline at end of file
@@ -1,4 +1,6 @@
 from langchain_openai import ChatOpenAI # type: ignore
+from contextlib import aclosing, closing
+from typing import Callable
 import os
 
 def get_chat_model(model_name, temperature):
@@ -8,7 +10,76 @@ def get_chat_model(model_name, temperature):
         max_tokens=None,
         timeout=None,
         max_retries=2,
+        # Usage comes in the last chunk when streaming
+        stream_usage=True,
         base_url="https://api.groq.com/openai/v1",
         api_key=os.environ.get("GROQ_API_KEY")
     )
-    return llm
\ No newline at end of file
+    return llm
+
+
+def stream_until(llm, messages, done: Callable[[str], bool], max_tokens: int) -> tuple[str, int, bool]:
+    """
+    Stream a chat completion and stop reading as soon as the text so far is enough.
+    Closing the stream drops the connection, so the rest of the answer is never generated.
+
+    Args:
+        llm: Chat model
+        messages (list): Messages to send
+        done (Callable[[str], bool]): Called with the accumulated text after each chunk
+        max_tokens (int): Give up after this many streamed chunks (roughly tokens)
+
+    Returns:
+        tuple[str, int, bool]: Text so far, total tokens (reported or estimated), whether done() matched
+    """
+    text = ""
+    chunks = 0
+    usage = None
+    matched = False
+
+    with closing(iter(llm.stream(messages))) as stream:
+        for chunk in stream:
+            if chunk.usage_metadata:
+                usage = chunk.usage_metadata
+            if not chunk.content:
+                continue
+            text += chunk.content
+            chunks += 1
+            if done(text):
+                matched = True
+                break
+            if chunks >= max_tokens:
+                break
+
+    return text, _stream_tokens(usage, chunks, messages), matched
+
+
+async def astream_until(llm, messages, done: Callable[[str], bool], max_tokens: int) -> tuple[str, int, bool]:
+    """Async stream_until, on llm.astream."""
+    text = ""
+    chunks = 0
+    usage = None
+    matched = False
+
+    async with aclosing(llm.astream(messages)) as stream:
+        async for chunk in stream:
+            if chunk.usage_metadata:
+                usage = chunk.usage_metadata
+            if not chunk.content:
+                continue
+            text += chunk.content
+            chunks += 1
+            if done(text):
+                matched = True
+                break
+            if chunks >= max_tokens:
+                break
+
+    return text, _stream_tokens(usage, chunks, messages), matched
+
+
+def _stream_tokens(usage, chunks: int, messages) -> int:
+    if usage:
+        return usage["total_tokens"]
+    # Stopped before the usage chunk, estimate the prompt at ~4 chars per token
+    return chunks + sum(len(str(m.content)) for m in messages) // 4
@@ -27,7 +27,13 @@ host = os.environ['POSTGRES_HOST']
 
 DATABASE_URL = f"postgresql://{user}:{pw}@{host}:5432/postgres"
 
-engine = create_engine(DATABASE_URL)
+# Sized explicitly since it counts against the RDS limit like the psycopg pools.
+# Every session here lives for one user lookup (generate_answer closes its own before streaming),
+# so this bounds concurrent lookups per worker, not concurrent streams
+AUTH_POOL_SIZE = int(os.getenv("AUTH_POOL_SIZE", "5"))
+AUTH_POOL_MAX_OVERFLOW = int(os.getenv("AUTH_POOL_MAX_OVERFLOW", "5"))
+
+engine = create_engine(DATABASE_URL, pool_size=AUTH_POOL_SIZE, max_overflow=AUTH_POOL_MAX_OVERFLOW)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
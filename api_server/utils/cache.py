@@ -0,0 +1,149 @@
+from collections import OrderedDict
+import psycopg # type: ignore
+import threading
+import asyncio
+import time
+
+
+class LRUCache:
+    """
+    Small thread-safe in-process LRU with an optional TTL.
+    Sync graph nodes run in executor threads, so everything goes through one lock.
+
+    Attributes:
+        maxsize -- max number of entries, least recently used is evicted first
+        ttl -- seconds an entry stays valid, None means forever
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class PostgresTier:
+    """
+    Persistent tier in Postgres behind an in-process cache, shared by all workers.
+    Subclasses list their CREATE statements in SCHEMA and read and write through the helpers below.
+    The tier is only an optimization, a failed read is a miss and a failed write is logged and dropped.
+    """
+
+    # Used in the log lines, e.g. "Search cache read failed"
+    LABEL = "Cache"
+    SCHEMA: tuple[str, ...] = ()
+
+    def __init__(self):
+        self.pool = None
+        self.async_pool = None
+
+
+    def bind(self, pool, async_pool=None):
+        """Use a psycopg ConnectionPool (and AsyncConnectionPool if open) for the persistent tier."""
+        self.pool = pool
+        self.async_pool = async_pool
+
+
+    def setup(self):
+        if self.pool is None:
+            return
+        with self.pool.connection() as conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+
+
+    def _read(self, query: str, params: tuple) -> list[dict]:
+        if self.pool is None:
+            return []
+        try:
+            with self.pool.connection() as conn:
+                return conn.execute(query, params).fetchall()
+        except psycopg.Error as e:
+            print(f"{self.LABEL} read failed: {e}")
+            return []
+
+
+    def _write(self, query: str, params: tuple | list, many: bool = False):
+        """One statement, or with many=True the statement once per params tuple."""
+        if self.pool is None:
+            return
+        try:
+            with self.pool.connection() as conn:
+                if many:
+                    with conn.cursor() as cur:
+                        cur.executemany(query, params)
+                else:
+                    conn.execute(query, params)
+        except psycopg.Error as e:
+            print(f"{self.LABEL} write failed: {e}")
+
+
+    async def _aread(self, query: str, params: tuple) -> list[dict]:
+        # Without the async pool the blocking read runs in a thread
+        if self.async_pool is None:
+            return await asyncio.to_thread(self._read, query, params)
+        try:
+            async with self.async_pool.connection() as conn:
+                cur = await conn.execute(query, params)
+                return await cur.fetchall()
+        except psycopg.Error as e:
+            print(f"{self.LABEL} read failed: {e}")
+            return []
+
+
+    async def _awrite(self, query: str, params: tuple | list, many: bool = False):
+        if self.async_pool is None:
+            return await asyncio.to_thread(self._write, query, params, many)
+        try:
+            async with self.async_pool.connection() as conn:
+                if many:
+                    async with conn.cursor() as cur:
+                        await cur.executemany(query, params)
+                else:
+                    await conn.execute(query, params)
+        except psycopg.Error as e:
+            print(f"{self.LABEL} write failed: {e}")
@@ -1,40 +1,435 @@
 from langgraph.store.postgres import PostgresStore # type: ignore
+from langgraph.store.postgres.aio import AsyncPostgresStore # type: ignore
+from psycopg_pool import AsyncConnectionPool, ConnectionPool # type: ignore
+from psycopg.rows import dict_row # type: ignore
+from contextlib import asynccontextmanager, contextmanager
+from psycopg import sql # type: ignore
+import math
 import os
+import re
 
+# Per process, so size these with the number of API workers in mind
+POOL_MIN_SIZE = int(os.getenv("POSTGRES_POOL_MIN_SIZE", "2"))
+POOL_MAX_SIZE = int(os.getenv("POSTGRES_POOL_MAX_SIZE", "10"))
+# Seconds to wait for a free connection before failing
+POOL_TIMEOUT = float(os.getenv("POSTGRES_POOL_TIMEOUT", "10"))
+POOL_MAX_IDLE = float(os.getenv("POSTGRES_POOL_MAX_IDLE", "600"))
+
+# The embedding cache gets its own pool, PostgresStore calls the embedder while it holds a connection
+# of the main pool, borrowing a second one from that same pool runs it dry under concurrent puts
+EMBED_CACHE_POOL_SIZE = int(os.getenv("POSTGRES_EMBED_CACHE_POOL_SIZE", "2"))
+# The cache is only an optimization, a busy pool is a quick miss instead of a stall
+EMBED_CACHE_POOL_TIMEOUT = float(os.getenv("POSTGRES_EMBED_CACHE_POOL_TIMEOUT", "2"))
+
+# PostgresStore needs autocommit, no prepared statements and dict rows
+CONNECTION_KWARGS = {
+    "autocommit": True,
+    "prepare_threshold": 0,
+    "row_factory": dict_row,
+}
+
+# Vector index on store_vectors, "hnsw", "ivfflat" or "flat" (no index, exact scans)
+ANN_INDEX_KIND = os.getenv("ANN_INDEX_KIND", "hnsw")
+# HNSW build parameters, pgvector defaults
+ANN_HNSW_M = int(os.getenv("ANN_HNSW_M", "16"))
+ANN_HNSW_EF_CONSTRUCTION = int(os.getenv("ANN_HNSW_EF_CONSTRUCTION", "64"))
+# IVFFlat lists, around rows / 1000 up to a million rows
+ANN_IVFFLAT_LISTS = int(os.getenv("ANN_IVFFLAT_LISTS", "100"))
+# Query time recall/speed knobs, set on every pooled connection
+ANN_EF_SEARCH = int(os.getenv("ANN_EF_SEARCH", "40"))
+ANN_PROBES = int(os.getenv("ANN_PROBES", "10"))
+
+# Same name the store's own migration uses, so there is only ever one index
+ANN_INDEX_NAME = "store_vectors_embedding_idx"
+
+# What pgvector uses when the index was built without a WITH clause
+PGVECTOR_DEFAULTS = {"hnsw": {"m": 16, "ef_construction": 64}, "ivfflat": {"lists": 100}}
+
+DISTANCE_OPS = {"cosine": "vector_cosine_ops", "l2": "vector_l2_ops", "inner_product": "vector_ip_ops"}
+
+VECTORS_QUERY = """
+    SELECT key, embedding::real[] AS embedding
+    FROM store_vectors
+    WHERE prefix = %s AND key = ANY(%s) AND field_name = %s
+"""
+
+NEARBY_QUERY = """
+    WITH nearby AS MATERIALIZED (
+        SELECT prefix, key, value FROM store
+        WHERE prefix = %(prefix)s
+          AND (value->>'lat')::float8 BETWEEN %(lat_min)s AND %(lat_max)s
+          AND (value->>'lon')::float8 BETWEEN %(lon_min)s AND %(lon_max)s
+    )
+    SELECT nearby.key, nearby.value, 1 - (sv.embedding <=> %(vector)s::vector) AS score
+    FROM nearby
+    JOIN store_vectors sv ON sv.prefix = nearby.prefix AND sv.key = nearby.key
+    WHERE sv.field_name = %(field)s
+    ORDER BY sv.embedding <=> %(vector)s::vector
+    LIMIT %(limit)s
+"""
+
+
+def postgres_url() -> str:
+    user = os.environ['POSTGRES_USER']
+    pw = os.environ['POSTGRES_PASSWORD']
+    host = os.environ['POSTGRES_HOST']
+    return f"postgresql://{user}:{pw}@{host}:5432/postgres"
+
+
+def ann_index_params(kind: str = ANN_INDEX_KIND) -> dict:
+    """Build parameters of an index kind, as in CREATE INDEX ... WITH (...)."""
+    if kind == "hnsw":
+        return {"m": ANN_HNSW_M, "ef_construction": ANN_HNSW_EF_CONSTRUCTION}
+    if kind == "ivfflat":
+        return {"lists": ANN_IVFFLAT_LISTS}
+    if kind == "flat":
+        return {}
+    raise ValueError(f"Unknown ANN index kind: {kind}")
+
+
+def ann_search_settings(ef_search: int = ANN_EF_SEARCH, probes: int = ANN_PROBES, local: bool = False) -> list:
+    """SET statements for the query time knobs, SET LOCAL ones only last for the current transaction."""
+    set_ = sql.SQL("SET LOCAL" if local else "SET")
+    return [
+        sql.SQL("{} hnsw.ef_search = {}").format(set_, sql.Literal(ef_search)),
+        sql.SQL("{} ivfflat.probes = {}").format(set_, sql.Literal(probes)),
+    ]
+
+
+def index_definition(conn, name: str) -> dict | None:
+    """
+    The current definition of an index.
+
+    Returns:
+        dict | None: Keys "kind", "params" and "valid", None when the index doesn't exist
+    """
+    row = conn.execute("""
+        SELECT pg_get_indexdef(i.indexrelid) AS indexdef, i.indisvalid AS valid
+        FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s
+    """, (name,)).fetchone()
+    if row is None:
+        return None
+
+    kind = re.search(r"USING (\w+)", row["indexdef"]).group(1)
+    with_clause = re.search(r"WITH \((.*)\)", row["indexdef"])
+    params = dict(PGVECTOR_DEFAULTS.get(kind, {}))
+    if with_clause:
+        for pair in with_clause.group(1).split(","):
+            key, value = pair.split("=")
+            params[key.strip()] = int(value.strip().strip("'"))
+    return {"kind": kind, "params": params, "valid": row["valid"]}
+
+
+def create_ann_index(conn, table: str, name: str, kind: str, params: dict, ops: str = "vector_cosine_ops"):
+    """
+    (Re)build a pgvector index without blocking writes.
+    Built under a temporary name and swapped in, so queries always have an index to use.
+    Needs an autocommit connection, CONCURRENTLY can't run in a transaction.
+    """
+    building = f"{name}_building"
+    conn.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(building)))
+
+    with_clause = sql.SQL("")
+    if params:
+        with_clause = sql.SQL(" WITH ({})").format(sql.SQL(", ").join(
+            sql.SQL("{} = {}").format(sql.Identifier(key), sql.Literal(value)) for key, value in params.items()))
+
+    conn.execute(sql.SQL("CREATE INDEX CONCURRENTLY {} ON {} USING {} (embedding {}){}").format(
+        sql.Identifier(building), sql.Identifier(table), sql.SQL(kind), sql.SQL(ops), with_clause))
+    conn.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(name)))
+    conn.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(sql.Identifier(building), sql.Identifier(name)))
 
-class ConnectPostgres:
-    def __init__(self, embeddings, dims):
-        user = os.environ['POSTGRES_USER']
-        pw = os.environ['POSTGRES_PASSWORD']
-        host = os.environ['POSTGRES_HOST']
 
-        connection_string=f"postgresql://{user}:{pw}@{host}:5432/postgres"
+def _nearby_params(namespace: tuple, field: str, query_vector: list[float],
+                   lat: float, lon: float, radius: float, limit: int) -> dict:
+    lat_delta = radius / 111320.0
+    lon_delta = radius / (111320.0 * max(math.cos(math.radians(lat)), 0.01))
+    return {
+        "prefix": ".".join(namespace),
+        "lat_min": lat - lat_delta, "lat_max": lat + lat_delta,
+        "lon_min": lon - lon_delta, "lon_max": lon + lon_delta,
+        "vector": "[" + ",".join(str(float(x)) for x in query_vector) + "]",
+        "field": field,
+        "limit": limit,
+    }
+
+
+class ConnectPostgres:
+    def __init__(self, embeddings, dims,
+                 min_size: int = POOL_MIN_SIZE,
+                 max_size: int = POOL_MAX_SIZE,
+                 timeout: float = POOL_TIMEOUT,
+                 max_idle: float = POOL_MAX_IDLE,
+                 ann_kind: str = ANN_INDEX_KIND):
+        connection_string = postgres_url()
 
         self.connection_string = connection_string
         self.embeddings = embeddings
         self.dims = dims
-        self.user = user
-        self.pw = pw
+        self.user = os.environ['POSTGRES_USER']
+        self.pw = os.environ['POSTGRES_PASSWORD']
+        self.pool_config = {
+            "min_size": min_size,
+            "max_size": max_size,
+            "timeout": timeout,
+            "max_idle": max_idle,
+        }
+
+        self.ann_kind = ann_kind
+        self.ann_params = ann_index_params(ann_kind)
+        self.ann_settings = ann_search_settings()
+
+        self.index_config = {
+            "dims": self.dims,
+            "embed": self.embeddings,
+            # The store builds this index on a fresh database, migrate_ann_index() keeps it in line afterwards
+            "ann_index_config": {"kind": ann_kind, **{("nlist" if key == "lists" else key): value
+                                                      for key, value in self.ann_params.items()}},
+            "distance_type": "cosine"
+             # distance_type: Literal["l2", "inner_product", "cosine"]
+              # Distance metric to use for vector similarity search:
+              # 'l2': Euclidean distance
+              # 'inner_product': Dot product
+              # 'cosine': Cosine similarity
+              #
+        }
+
+        # One pool per process, connections are borrowed per store operation
+        self.pool = ConnectionPool(
+            connection_string,
+            **self.pool_config,
+            # Validate connections on checkout, RDS drops idle ones
+            check=ConnectionPool.check_connection,
+            kwargs=CONNECTION_KWARGS,
+            configure=self._configure,
+            open=True,
+        )
+
+        self.store = PostgresStore(self.pool, index=self.index_config)
+
+        self.cache_pool_config = {
+            "min_size": 1,
+            "max_size": EMBED_CACHE_POOL_SIZE,
+            "timeout": EMBED_CACHE_POOL_TIMEOUT,
+            "max_idle": max_idle,
+        }
+        # For CachedEmbeddings.bind()
+        self.cache_pool = ConnectionPool(
+            connection_string,
+            **self.cache_pool_config,
+            check=ConnectionPool.check_connection,
+            kwargs=CONNECTION_KWARGS,
+            open=True,
+        )
+
+        # Opened with aopen() when the graph runs in async mode
+        self.async_pool = None
+        self.async_store = None
+        self.async_cache_pool = None
+
+
+    def _configure(self, conn):
+        # Session defaults for the ANN index, every store.search on this connection uses them
+        for statement in self.ann_settings:
+            conn.execute(statement)
 
 
+    async def _aconfigure(self, conn):
+        for statement in self.ann_settings:
+            await conn.execute(statement)
+
+
+    async def aopen(self):
+        """
+        Open the AsyncConnectionPool and AsyncPostgresStore, must run inside the serving event loop.
+        """
+        if self.async_pool is not None:
+            return
+        self.async_pool = AsyncConnectionPool(
+            self.connection_string,
+            **self.pool_config,
+            check=AsyncConnectionPool.check_connection,
+            kwargs=CONNECTION_KWARGS,
+            configure=self._aconfigure,
+            open=False,
+        )
+        await self.async_pool.open()
+        self.async_store = AsyncPostgresStore(self.async_pool, index=self.index_config)
+
+        self.async_cache_pool = AsyncConnectionPool(
+            self.connection_string,
+            **self.cache_pool_config,
+            check=AsyncConnectionPool.check_connection,
+            kwargs=CONNECTION_KWARGS,
+            open=False,
+        )
+        await self.async_cache_pool.open()
+
+
+    @contextmanager
     def get_store(self):
         """
-        Create and return a PostgresStore instance.
+        Yield the shared PostgresStore instance.
+        Every store operation borrows a connection from the pool and returns it when done.
 
         Returns:
             PostgresStore: Configured PostgresStore instance.
         """
-        return PostgresStore.from_conn_string(
-            self.connection_string,
-            index={
-                "dims": self.dims,
-                "embed": self.embeddings,
-                "distance_type": "cosine"
-                 # distance_type: Literal["l2", "inner_product", "cosine"]
-                  # Distance metric to use for vector similarity search:
-                  # 'l2': Euclidean distance
-                  # 'inner_product': Dot product
-                  # 'cosine': Cosine similarity
-                  # 
-            },
-        )
\ No newline at end of file
+        yield self.store
+
+
+    @asynccontextmanager
+    async def get_async_store(self):
+        """
+        Yield the shared AsyncPostgresStore instance, aopen() has to be called first.
+
+        Returns:
+            AsyncPostgresStore: Configured AsyncPostgresStore instance.
+        """
+        yield self.async_store
+
+
+    def get_vectors(self, namespace: tuple, keys: list[str], field: str, conn=None) -> dict:
+        """
+        Read stored embeddings straight from the store_vectors table, one query for all keys.
+
+        Args:
+            namespace (tuple): Store namespace, e.g. ("restaurants",)
+            keys (list[str]): Item keys
+            field (str): Indexed field, e.g. "reviews"
+            conn: Connection already held by the caller (e.g. inside its transaction), else one from the pool
+
+        Returns:
+            dict: Vectors (list[float]) keyed by item key, missing keys are left out
+        """
+        if not keys:
+            return {}
+        if conn is not None:
+            rows = conn.execute(VECTORS_QUERY, (".".join(namespace), list(keys), field)).fetchall()
+        else:
+            with self.pool.connection() as conn:
+                rows = conn.execute(VECTORS_QUERY, (".".join(namespace), list(keys), field)).fetchall()
+        return {row["key"]: row["embedding"] for row in rows}
+
+
+    async def aget_vectors(self, namespace: tuple, keys: list[str], field: str, conn=None) -> dict:
+        if not keys:
+            return {}
+        if conn is not None:
+            cur = await conn.execute(VECTORS_QUERY, (".".join(namespace), list(keys), field))
+            rows = await cur.fetchall()
+        else:
+            async with self.async_pool.connection() as conn:
+                cur = await conn.execute(VECTORS_QUERY, (".".join(namespace), list(keys), field))
+                rows = await cur.fetchall()
+        return {row["key"]: row["embedding"] for row in rows}
+
+
+    def setup_geo_index(self):
+        """
+        Expression index on the coordinates saved with ("restaurants",) records, for bounding box lookups.
+        """
+        with self.pool.connection() as conn:
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS store_restaurants_geo_idx
+                ON store (((value->>'lat')::float8), ((value->>'lon')::float8))
+                WHERE prefix = 'restaurants'
+            """)
+
+
+    def migrate_ann_index(self) -> str:
+        """
+        Make the store_vectors index match the configured kind and build parameters.
+        Idempotent, an index that already matches is left alone.
+
+        Returns:
+            str: "unchanged", "created", "rebuilt" or "dropped"
+        """
+        with self.pool.connection() as conn:
+            current = index_definition(conn, ANN_INDEX_NAME)
+
+            if self.ann_kind == "flat":
+                if current is None:
+                    return "unchanged"
+                conn.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(ANN_INDEX_NAME)))
+                print(f"Dropped ANN index {ANN_INDEX_NAME}")
+                return "dropped"
+
+            # An interrupted concurrent build leaves an invalid index behind, rebuild that too
+            if current and current["valid"] and current["kind"] == self.ann_kind and current["params"] == self.ann_params:
+                return "unchanged"
+
+            print(f"Building {self.ann_kind} index {ANN_INDEX_NAME} {self.ann_params}, was {current}")
+            create_ann_index(conn, "store_vectors", ANN_INDEX_NAME, self.ann_kind, self.ann_params,
+                             DISTANCE_OPS[self.index_config["distance_type"]])
+            return "created" if current is None else "rebuilt"
+
+
+    def search_nearby(self, namespace: tuple, field: str, query_vector: list[float],
+                      lat: float, lon: float, radius: float, limit: int,
+                      ef_search: int | None = None, probes: int | None = None) -> list[dict]:
+        """
+        Vector search restricted to records within a bounding box around a point.
+        The box is resolved first with the geo index, so the cosine ordering only runs over nearby rows.
+        When the planner goes through the ANN index instead, the box filters its candidates,
+        ef_search / probes set how many there are for this query only (pool defaults otherwise).
+
+        Args:
+            namespace (tuple): Store namespace, records need "lat" and "lon" in their value
+            field (str): Indexed field to compare against
+            query_vector (list[float]): Embedded query
+            lat, lon (float): Center point
+            radius (float): Half the box side, meters
+            limit (int): Max rows
+            ef_search, probes (int | None): HNSW / IVFFlat query time settings
+
+        Returns:
+            list[dict]: Keys "key", "value", "score", best first
+        """
+        params = _nearby_params(namespace, field, query_vector, lat, lon, radius, limit)
+        with self.pool.connection() as conn:
+            with conn.transaction():
+                for statement in ann_search_settings(ef_search or ANN_EF_SEARCH, probes or ANN_PROBES, local=True):
+                    conn.execute(statement)
+                rows = conn.execute(NEARBY_QUERY, params).fetchall()
+        return [dict(row) for row in rows]
+
+
+    async def asearch_nearby(self, namespace: tuple, field: str, query_vector: list[float],
+                             lat: float, lon: float, radius: float, limit: int,
+                             ef_search: int | None = None, probes: int | None = None) -> list[dict]:
+        params = _nearby_params(namespace, field, query_vector, lat, lon, radius, limit)
+        async with self.async_pool.connection() as conn:
+            async with conn.transaction():
+                for statement in ann_search_settings(ef_search or ANN_EF_SEARCH, probes or ANN_PROBES, local=True):
+                    await conn.execute(statement)
+                cur = await conn.execute(NEARBY_QUERY, params)
+                rows = await cur.fetchall()
+        return [dict(row) for row in rows]
+
+
+    def stats(self) -> dict:
+        """
+        Connection pool statistics, e.g. pool_size, pool_available, requests_waiting.
+        """
+        stats = self.pool.get_stats()
+        if self.async_pool is not None:
+            stats = {"sync": stats, "async": self.async_pool.get_stats()}
+        stats["embedding_cache"] = self.cache_pool.get_stats()
+        if self.async_cache_pool is not None:
+            stats["async_embedding_cache"] = self.async_cache_pool.get_stats()
+        return stats
+
+
+    def close(self):
+        self.pool.close()
+        self.cache_pool.close()
+
+
+    async def aclose(self):
+        if self.async_pool is not None:
+            await self.async_pool.close()
+        if self.async_cache_pool is not None:
+            await self.async_cache_pool.close()
+        self.close()
@@ -0,0 +1,153 @@
+from langchain_core.embeddings import Embeddings # type: ignore
+import hashlib
+import os
+
+from utils.cache import LRUCache, PostgresTier
+
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "20000"))
+
+READ_QUERY = "SELECT key, embedding FROM embedding_cache WHERE key = ANY(%s)"
+
+WRITE_QUERY = """
+    INSERT INTO embedding_cache (key, model, embedding)
+    VALUES (%s, %s, %s::real[])
+    ON CONFLICT (key) DO NOTHING
+"""
+
+
+class CachedEmbeddings(PostgresTier, Embeddings):
+    """
+    Content-hash cache in front of an embeddings model.
+    Vectors are keyed by sha256 of model name + text, looked up first from an in-process LRU,
+    then from the embedding_cache table in Postgres. Only the misses are sent upstream, in one batch.
+
+    Queries and documents are cached separately, Google embeds them with different task types.
+    """
+
+    LABEL = "Embedding cache"
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            embedding REAL[] NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT now()
+        )
+        """,
+    )
+
+    def __init__(self, embeddings: Embeddings, model_name: str, maxsize: int = EMBED_CACHE_SIZE):
+        super().__init__()
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.lru = LRUCache(maxsize)
+        self.db_hits = 0
+        self.upstream_calls = 0
+        self.upstream_texts = 0
+
+
+    def _key(self, kind: str, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\x00{kind}\x00{text}".encode()).hexdigest()
+
+
+    def _loaded(self, rows: list[dict]) -> dict:
+        return {row["key"]: row["embedding"] for row in rows}
+
+
+    def _rows(self, vectors: dict) -> list[tuple]:
+        return [(key, self.model_name, vector) for key, vector in vectors.items()]
+
+
+    def _from_memory(self, kind: str, texts: list[str]) -> tuple[list[str], dict]:
+        keys = [self._key(kind, text) for text in texts]
+        found = {}
+
+        for key in set(keys):
+            vector = self.lru.get(key)
+            if vector is not None:
+                found[key] = vector
+        return keys, found
+
+
+    def _remember(self, found: dict, vectors: dict):
+        for key, vector in vectors.items():
+            self.lru.set(key, vector)
+        found.update(vectors)
+
+
+    def _missing(self, keys: list[str], texts: list[str], found: dict) -> dict:
+        # Duplicates in the same batch are embedded once
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            self.upstream_calls += 1
+            self.upstream_texts += len(missing)
+        return missing
+
+
+    def _embed(self, kind: str, texts: list[str]) -> list[list[float]]:
+        keys, found = self._from_memory(kind, texts)
+
+        unseen = [key for key in set(keys) if key not in found]
+        loaded = self._loaded(self._read(READ_QUERY, (unseen,))) if unseen else {}
+        self.db_hits += len(loaded)
+        self._remember(found, loaded)
+
+        missing = self._missing(keys, texts, found)
+        if missing:
+            if kind == "query":
+                new_vectors = [self.embeddings.embed_query(text) for text in missing.values()]
+            else:
+                new_vectors = self.embeddings.embed_documents(list(missing.values()))
+
+            fresh = dict(zip(missing.keys(), new_vectors))
+            self._remember(found, fresh)
+            self._write(WRITE_QUERY, self._rows(fresh), many=True)
+
+        return [found[key] for key in keys]
+
+
+    async def _aembed(self, kind: str, texts: list[str]) -> list[list[float]]:
+        keys, found = self._from_memory(kind, texts)
+
+        unseen = [key for key in set(keys) if key not in found]
+        loaded = self._loaded(await self._aread(READ_QUERY, (unseen,))) if unseen else {}
+        self.db_hits += len(loaded)
+        self._remember(found, loaded)
+
+        missing = self._missing(keys, texts, found)
+        if missing:
+            if kind == "query":
+                new_vectors = [await self.embeddings.aembed_query(text) for text in missing.values()]
+            else:
+                new_vectors = await self.embeddings.aembed_documents(list(missing.values()))
+
+            fresh = dict(zip(missing.keys(), new_vectors))
+            self._remember(found, fresh)
+            await self._awrite(WRITE_QUERY, self._rows(fresh), many=True)
+
+        return [found[key] for key in keys]
+
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embed("document", texts)
+
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed("query", [text])[0]
+
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self._aembed("document", texts)
+
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return (await self._aembed("query", [text]))[0]
+
+
+    def stats(self) -> dict:
+        return {
+            **self.lru.stats(),
+            "db_hits": self.db_hits,
+            "upstream_calls": self.upstream_calls,
+            "upstream_texts": self.upstream_texts,
+        }
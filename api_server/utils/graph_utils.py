@@ -1,61 +1,92 @@
-from fuzzywuzzy import fuzz # type: ignore
+from rapidfuzz import fuzz, process # type: ignore
+import numpy as np # type: ignore
+import re
 
-def check_preference_negative(restaurant_name, pref):
-    # Normalize and prepare text
-    restaurant_name = restaurant_name.lower()
-    pref = pref.lower()
+from utils.ranking import cosine_similarity
+from utils.restaurant import Restaurant
 
+NEGATIVE_KEYWORDS = ["no", "not", "never", "don't like", "dont like", "hate", "dislike", "avoid"]
+
+# Compiled once, same substring semantics as checking each keyword with `in`
+NEGATION_PATTERN = re.compile("|".join(re.escape(neg_word) for neg_word in NEGATIVE_KEYWORDS))
+
+# fuzzywuzzy rounded ratio to int and required > 49, rapidfuzz returns the unrounded float
+NEGATIVE_MATCH_CUTOFF = 49.5
+
+
+def is_negative_preference(pref: str) -> bool:
     # Check for negative phrases
-    negative_keywords = ["no", "not", "never", "don't like", "dont like", "hate", "dislike", "avoid"]
-    if not any(neg_word in pref for neg_word in negative_keywords):
-        return "none"
+    return NEGATION_PATTERN.search(pref.lower()) is not None
 
-    # Fuzzy matching: check if restaurant name appears in the sentence
-    if fuzz.ratio(pref, restaurant_name) > 49:  # Allow some flexibility for spelling
-        return "pop"
 
-    return "none"
+def negative_preference_mask(restaurant_names: list[str], preferences: list[str], negative: list[bool] | None = None) -> np.ndarray:
+    """
+    Which restaurants a negative preference forbids, for all restaurants and preferences at once.
+    Fuzzy matching checks if restaurant name appears in the sentence, scored in a single rapidfuzz cdist call.
 
+    Args:
+        restaurant_names (list[str]): Restaurant names
+        preferences (list[str]): Preference texts
+        negative (list[bool] | None): Precomputed negation per preference, detected here if None
+
+    Returns:
+        np.ndarray: Bool per restaurant, True means 'pop'
+    """
+    if negative is None:
+        negative = [is_negative_preference(pref) for pref in preferences]
+
+    targets = [pref.lower() for pref, neg in zip(preferences, negative) if neg]
+    if not targets or not restaurant_names:
+        return np.zeros(len(restaurant_names), dtype=bool)
+
+    # Allow some flexibility for spelling
+    scores = process.cdist(targets, [name.lower() for name in restaurant_names], scorer=fuzz.ratio)
+    return (scores >= NEGATIVE_MATCH_CUTOFF).any(axis=0)
+
+
+# A preference boosts a restaurant if the similarity clears this,
+# but only among the PREFERENCE_LIMIT best restaurants for that preference
+PREFERENCE_THRESHOLD = 0.4
+PREFERENCE_LIMIT = 9
 
-def check_preference_score(restaurant_list: list, user_id:str, user_preferences: list, db):
-    
-    for restaurant in restaurant_list:
-        with db.get_store() as store:
-            store.put(namespace=("rank_restaurants", user_id), 
-                      key=restaurant["name"], 
-                      value={
-                       "reviews": restaurant["reviews"],
-                      },
-                      index=["reviews"])
-    
-    boosted_names = []
-    for pref in user_preferences:
-
-        with db.get_store() as store:
-            score_items_per_pref = store.search(("rank_restaurants", user_id), query=pref.value["preference"], limit=9)
-            
-        
-        for item in score_items_per_pref:
-            if item.score >= 0.4:
-                boosted_names.append(item.key)
-
-    for restaurant in restaurant_list:
-        if restaurant["name"] in boosted_names:
-            restaurant["pref_note"] = 'boost'
-        else:
-            restaurant["pref_note"] = 'none'
+
+def check_preference_score(restaurant_list: list[Restaurant], review_vectors: np.ndarray, pref_vectors: np.ndarray):
+    """
+    Tag restaurants with 'boost' or 'none' with one preferences x restaurants similarity matrix.
+    Cost stays flat with the number of saved preferences, no store searches are made.
+
+    Args:
+        restaurant_list (list): Restaurants, aligned with review_vectors rows
+        review_vectors (np.ndarray): Shape (restaurants, dims)
+        pref_vectors (np.ndarray): Shape (preferences, dims)
+    """
+    boosted = np.zeros(len(restaurant_list), dtype=bool)
+
+    if len(restaurant_list) and len(pref_vectors):
+        similarity = cosine_similarity(pref_vectors, review_vectors)
+        passing = similarity >= PREFERENCE_THRESHOLD
+
+        # Same as limit=9 on a per preference search
+        if similarity.shape[1] > PREFERENCE_LIMIT:
+            ranks = np.argsort(np.argsort(-similarity, axis=1, kind="stable"), axis=1)
+            passing &= ranks < PREFERENCE_LIMIT
+
+        boosted = passing.any(axis=0)
+
+    for restaurant, boost in zip(restaurant_list, boosted):
+        restaurant.pref_note = 'boost' if boost else 'none'
 
     return restaurant_list
     
     
-def remove_duplicates(lst: list[dict]):
+def remove_duplicates(restaurants: dict[str, Restaurant]) -> dict[str, Restaurant]:
+    # Chains have a place id per location, keep the first one of each name
     seen = set()
-    unique_lst = []
-    
-    for d in lst:
-        name = d.get('name')
-        if name not in seen:
-            seen.add(name)
-            unique_lst.append(d)
-    
-    return unique_lst
\ No newline at end of file
+    unique = {}
+
+    for id, restaurant in restaurants.items():
+        if restaurant.name not in seen:
+            seen.add(restaurant.name)
+            unique[id] = restaurant
+
+    return unique
\ No newline at end of file
@@ -1,27 +1,109 @@
-import requests # type: ignore
+import httpx # type: ignore
+from typing import Callable
+import asyncio
+import time
 import os
 
+from utils.errors import RateLimitError
+from utils.search_cache import SearchCache
+from utils.photos import PhotoCache, photo_url, verify_photo_ref
+from utils.restaurant import Restaurant
+from utils.refresher import BackgroundRefresher
+from utils.singleflight import SingleFlight
+from utils.write_behind import WriteBehindQueue
+
 GMAPS_API_KEY = os.getenv("GMAPS_API_KEY")
 
-def get_restaurants(query: str, db, location) -> list[dict]:
-    """
-    Queries the Places API (new).
-    First gets place IDs with Text Search, then details with Place Details.
-    Save the results of details query, and first match ids agains the saved ones.
-    Because IDs are free to query, this saves API credits by only querying details of the not saved ones.
+# Overridable to run against a stub server locally
+PLACES_API_URL = os.getenv("PLACES_API_URL", "https://places.googleapis.com/v1")
 
-    Args:
-        input (str): LLM generated query string
+# How many Place Details / photo calls can be in flight at once per process
+PLACES_MAX_CONCURRENCY = int(os.getenv("PLACES_MAX_CONCURRENCY", "9"))
+PLACES_TIMEOUT = float(os.getenv("PLACES_TIMEOUT", "10"))
+
+# Location bias circle for Text Search, meters
+SEARCH_RADIUS = 1000.0
+
+# Serve from already saved restaurants when this many relevant ones are within SEARCH_RADIUS
+LOCAL_FIRST = os.getenv("LOCAL_FIRST", "true").lower() == "true"
+LOCAL_MIN_RESULTS = int(os.getenv("LOCAL_MIN_RESULTS", "9"))
+LOCAL_MIN_SCORE = float(os.getenv("LOCAL_MIN_SCORE", "0.55"))
+# The box drops most of what an ANN scan returns, so the nearby search asks for more candidates than the default
+LOCAL_EF_SEARCH = int(os.getenv("LOCAL_EF_SEARCH", "200"))
+LOCAL_PROBES = int(os.getenv("LOCAL_PROBES", "20"))
+
+# Saved restaurants older than this are still served, and refreshed in the background
+RESTAURANT_TTL = float(os.getenv("RESTAURANT_TTL", str(7 * 24 * 60 * 60)))
+
+PHOTO_MAX_HEIGHT = 400
+PHOTO_MAX_WIDTH = 400
+
+# Shared between requests so connections to Google are kept alive
+_client: httpx.AsyncClient | None = None
+_semaphore: asyncio.Semaphore | None = None
+
+# Text Search results by query and neighbourhood, bound to Postgres on startup
+search_cache = SearchCache()
+
+# Resolved photo URIs for /api/photo, bound to Postgres on startup
+photo_cache = PhotoCache()
+
+# Place Details in flight, concurrent requests for the same place pay for one call
+details_flight = SingleFlight()
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Lazily create the pooled Places API client.
 
     Returns:
-        list[dict]: Dict keys "name", "reviews", "rating", "maps_uri", "delivery", "photo"
+        httpx.AsyncClient: Client shared by every request in this process.
+    """
+    global _client, _semaphore
+
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=PLACES_API_URL,
+            timeout=PLACES_TIMEOUT,
+            limits=httpx.Limits(max_connections=PLACES_MAX_CONCURRENCY * 2,
+                                max_keepalive_connections=PLACES_MAX_CONCURRENCY),
+        )
+        _semaphore = asyncio.Semaphore(PLACES_MAX_CONCURRENCY)
+    return _client
+
+
+async def close_client():
+    global _client
+
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _request(method: str, url: str, **kwargs) -> httpx.Response:
+    client = get_client()
+
+    # Bounded, so a burst of requests can't open hundreds of sockets to Google
+    async with _semaphore:
+        response = await client.request(method, url, **kwargs)
+
+    if response.status_code == 429:
+        raise RateLimitError('Rate limits hit', 'Google Maps API')
+    return response
+
+
+async def search_place_ids(query: str, location: dict) -> list[str]:
     """
+    Text Search restricted to place IDs, which are free to query.
+    Recent results for the same query near the same spot come from search_cache instead.
 
-    max_height = 400
-    max_width = 400
-    
-    url = "https://places.googleapis.com/v1/places:searchText"
+    Args:
+        query (str): LLM generated query string
+        location (dict): Keys "lat" and "lon"
 
+    Returns:
+        list[str]: Place IDs in the order Google ranked them
+    """
     # Using field mask to restrict to only free Place IDs
     headers = {
             "Content-Type": "application/json",
@@ -37,112 +119,358 @@ def get_restaurants(query: str, db, location) -> list[dict]:
             "locationBias": {
               "circle": {
                 "center": {"latitude": location['lat'], "longitude": location['lon']},
-                "radius": 1000.0
+                "radius": SEARCH_RADIUS
               }
             }
     }
-    response = requests.post(url, headers=headers, json=data)
+
+    cache_key = search_cache.key(query, location, SEARCH_RADIUS)
+    place_ids = await search_cache.aget(cache_key)
+    if place_ids is not None:
+        return place_ids
+
+    response = await _request("POST", "/places:searchText", headers=headers, json=data)
 
     if not response.json():
         raise ValueError("Could not query for restaurants with this input. If you only meant to indicate a preference, try being more specific")
 
-    place = {}
-    place_list = []
+    place_ids = [place["id"] for place in response.json()["places"]]
+    await search_cache.aset(cache_key, place_ids)
+    return place_ids
+
+
+async def fetch_place_details(place_id: str) -> dict:
+    """
+    Place Details for a single place.
+    These are expensive queries, careful
+    The photo is only referenced here, /api/photo resolves it when the card is rendered
+
+    Place Details (Basic) SKU: displayName | 0.0170 USD per each
+    Place Details (Preferred) SKU: reviews | 0.025 USD per each
+
+    Full set of totally new places: (0.017 + 0.025) * pageSize
+    with 5 places, total 0,21 USD (2/24/2025)
+
+    Returns:
+        dict: Keys "id", "name", "reviews", "rating", "maps_uri", "delivery", "photo", "photo_ref", "lat", "lon"
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "X-Goog-Api-Key": GMAPS_API_KEY,
+        "X-Goog-FieldMask": "reviews.text.text,displayName,delivery,photos,rating,googleMapsUri,location",
+    }
+    response = await _request("GET", f"/places/{place_id}", headers=headers)
+    data = response.json()
+
+    if "reviews" not in data.keys():
+        data["reviews"] = 'None'
+
+    # Only get two reviews
+    # TODO: scheck sorting, is it better to get first or last indices
+    reviews = data["reviews"][:5]
+
+    # Formatting in case LLM needs to operate on these
+    formatted_list = []
+    i = 1
+    for rev in reviews:
+        if "text" not in rev.keys():
+            formatted_list.append(f'Review not found')
+            continue
+        formatted_list.append(f'Review {i}: {rev["text"]["text"]}')
+        i += 1
+
+    # Get a photo of the place
+    selected_photo = data["photos"][0]["name"]
+    for photo in data["photos"]:
+        if data["displayName"]["text"] == photo["authorAttributions"][0]["displayName"]:
+            selected_photo = photo["name"]
+            break
+
+    if "delivery" not in data.keys():
+        data["delivery"] = "Unknown"
+    elif data["delivery"]:
+        data["delivery"] = "Available"
+    else:
+        data["delivery"] = "Not Available"
+
+    return {
+        "id": place_id,
+        "name": data["displayName"]["text"],
+        "reviews": formatted_list,
+        "rating": data["rating"],
+        "delivery": data["delivery"],
+        "maps_uri": data["googleMapsUri"],
+        "photo": photo_url(place_id, selected_photo),
+        "photo_ref": selected_photo,
+        "lat": data["location"]["latitude"],
+        "lon": data["location"]["longitude"],
+    }
+
+
+async def fetch_photo_uri(photo_ref: str) -> str:
+    """
+    Photo media lookup, the URI of the sized image for a photo reference.
+
+    Args:
+        photo_ref (str): Photo resource name, "places/{place_id}/photos/{photo_id}"
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "X-Goog-Api-Key": GMAPS_API_KEY,
+    }
+    params = {
+        "maxHeightPx": PHOTO_MAX_HEIGHT,
+        "maxWidthPx": PHOTO_MAX_WIDTH,
+        "skipHttpRedirect": "true",
+    }
+    response = await _request("GET", f"/{photo_ref}/media", headers=headers, params=params)
+    return response.json()["photoUri"]
+
+
+async def resolve_photo(db, place_id: str) -> str | None:
+    """
+    Photo URI of a saved place, resolved from the photo reference stored with it.
+    Only saved places are looked up, so the endpoint can't be used to query arbitrary places.
+
+    Returns:
+        str | None: Photo URI, None when the place is not saved
+    """
+    # Fetched but still waiting in this worker's write-behind queue. Pending records in other
+    # workers are covered by the signed reference in the photo URL, see photo_url
+    pending = place_writer.get(place_id)
+    if pending is not None and pending.get("photo_ref"):
+        return await fetch_photo_uri(pending["photo_ref"])
+
+    if db.async_store is not None:
+        async with db.get_async_store() as store:
+            item = await store.aget(("restaurants",), place_id)
+    else:
+        item = await asyncio.to_thread(db.store.get, ("restaurants",), place_id)
+
+    if item is None:
+        return None
+    if item.value.get("photo_ref"):
+        return await fetch_photo_uri(item.value["photo_ref"])
+    # Saved before photo references, the URI was resolved back then
+    return item.value.get("photo")
+
+
+async def get_place_details(place_id: str) -> dict:
+    """fetch_place_details, shared with any call for the same place already in flight."""
+    return await details_flight.do(place_id, lambda: fetch_place_details(place_id))
+
+
+def find_local_restaurants(query: str, db, location: dict) -> dict[str, Restaurant] | None:
+    """
+    Answer a query from saved restaurants near the location, no Places API calls.
+    Uses the geo index to find nearby records and their review embeddings for relevance.
+
+    Returns:
+        dict[str, Restaurant] | None: Same shape as get_restaurants, None when there are not enough relevant places nearby
+    """
+    if not LOCAL_FIRST:
+        return None
+
+    query_vector = db.embeddings.embed_query(query)
+    rows = db.search_nearby(("restaurants",), "reviews", query_vector,
+                            location["lat"], location["lon"], SEARCH_RADIUS, LOCAL_MIN_RESULTS,
+                            ef_search=LOCAL_EF_SEARCH, probes=LOCAL_PROBES)
+
+    return _relevant_places(rows)
+
+
+async def afind_local_restaurants(query: str, db, location: dict) -> dict[str, Restaurant] | None:
+    """Async find_local_restaurants, through the async pool."""
+    if not LOCAL_FIRST:
+        return None
+
+    query_vector = await db.embeddings.aembed_query(query)
+    rows = await db.asearch_nearby(("restaurants",), "reviews", query_vector,
+                                   location["lat"], location["lon"], SEARCH_RADIUS, LOCAL_MIN_RESULTS,
+                                   ef_search=LOCAL_EF_SEARCH, probes=LOCAL_PROBES)
+    return _relevant_places(rows)
+
+
+def _relevant_places(rows: list[dict]) -> dict[str, Restaurant] | None:
+    relevant = [row for row in rows if row["score"] >= LOCAL_MIN_SCORE]
+    if len(relevant) < LOCAL_MIN_RESULTS:
+        return None
+
+    refresh_stale({row["key"]: row["value"] for row in relevant})
+    # Best match first
+    return {row["key"]: Restaurant.from_value(row["key"], row["value"]) for row in relevant}
+
+
+def _get_ops(place_ids: list[str]) -> list:
+    # langgraph is imported on first use, the API imports this module before warm_up()
+    from langgraph.store.base import GetOp # type: ignore
+    return [GetOp(("restaurants",), id) for id in place_ids]
+
+
+def get_cached_places(db, place_ids: list[str]) -> tuple[dict, list[str]]:
+    """
+    Resolve saved places with one batched read instead of a store.get per id.
+
+    Returns:
+        tuple[dict, list[str]]: Saved values keyed by place id, and the ids that need a Place Details query
+    """
+    with db.get_store() as store:
+        items = store.batch(_get_ops(place_ids))
+    return _split_cached(place_ids, items)
+
+
+async def aget_cached_places(db, place_ids: list[str]) -> tuple[dict, list[str]]:
+    """Async get_cached_places, one batched read on the AsyncPostgresStore."""
+    async with db.get_async_store() as store:
+        items = await store.abatch(_get_ops(place_ids))
+    return _split_cached(place_ids, items)
+
+
+def _split_cached(place_ids: list[str], items: list) -> tuple[dict, list[str]]:
+    hits = {item.key: item.value for item in items if item}
+    misses = [id for id in place_ids if id not in hits]
+    return hits, misses
+
+
+def is_stale(value: dict, ttl: float = RESTAURANT_TTL) -> bool:
+    # Records saved before timestamps get one from backfill_fetched_at(), until then they are left alone
+    fetched_at = value.get("fetched_at")
+    return fetched_at is not None and time.time() - fetched_at > ttl
+
+
+def backfill_fetched_at(db, ttl: float = RESTAURANT_TTL) -> int:
+    """
+    Give saved restaurants without a fetched_at one, instead of refreshing them all at once.
+    Each gets a random time within the last TTL, so they come due spread over the next TTL.
+
+    Returns:
+        int: Records updated
+    """
+    with db.pool.connection() as conn:
+        cur = conn.execute("""
+            UPDATE store
+            SET value = value || jsonb_build_object('fetched_at', extract(epoch FROM now()) - random() * %s)
+            WHERE prefix = 'restaurants' AND NOT value ? 'fetched_at'
+        """, (ttl,))
+        return cur.rowcount
+
+
+def refresh_stale(saved: dict):
+    """Queue the stale ones of saved values (keyed by place id) for a background refresh."""
+    stale = [id for id, value in saved.items() if is_stale(value)]
+    if stale:
+        place_refresher.enqueue(stale)
+
+
+def _place_value(place: dict) -> dict:
+    return {
+        "name": place["name"],
+        "reviews": place["reviews"],
+        "rating": place["rating"],
+        "delivery": place["delivery"],
+        "maps_uri": place["maps_uri"],
+        "photo_ref": place["photo_ref"],
+        "lat": place["lat"],
+        "lon": place["lon"],
+        "fetched_at": time.time(),
+    }
+
+
+def _put_ops(places: list[dict]) -> list:
+    from langgraph.store.base import PutOp # type: ignore
+    # One batch is one insert round and one embedding call for all reviews
+    return [PutOp(("restaurants",), place["id"], _place_value(place), index=["reviews"]) for place in places]
+
+
+def _save_places(db, places: list[dict]):
+    if not places:
+        return
+    with db.get_store() as store:
+        store.batch(_put_ops(places))
+
+
+async def _asave_places(db, places: list[dict]):
+    if not places:
+        return
+    async with db.get_async_store() as store:
+        await store.abatch(_put_ops(places))
+
+
+async def store_places(db, places: list[dict]):
+    """Save fetched places, on the async store when it is open."""
+    if db.async_store is not None:
+        await _asave_places(db, places)
+    else:
+        await asyncio.to_thread(_save_places, db, places)
+
+
+# Stale-while-revalidate for ("restaurants",), started with the app
+place_refresher = BackgroundRefresher(get_place_details, store_places)
+
+# Newly fetched places are saved in batches off the request path, started with the app
+place_writer = WriteBehindQueue(store_places)
+
+
+async def get_restaurants(query: str, db, location, place_ids: list[str] | None = None,
+                          on_place: Callable[[Restaurant], None] | None = None) -> dict[str, Restaurant]:
+    """
+    Queries the Places API (new).
+    First gets place IDs with Text Search, then details with Place Details.
+    Save the results of details query, and first match ids agains the saved ones.
+    Because IDs are free to query, this saves API credits by only querying details of the not saved ones.
+    Details of the not saved ones are fetched concurrently.
+
+    Args:
+        input (str): LLM generated query string
+        place_ids (list[str] | None): Already searched IDs, e.g. prefetched by the speculative graph
+        on_place (Callable | None): Called with each place as soon as it is resolved, saved ones first
+
+    Returns:
+        dict[str, Restaurant]: Restaurants keyed by place id, in Text Search order
+    """
+    if place_ids is None:
+        place_ids = await search_place_ids(query, location)
 
     # Check if resulted IDs are stored, and get the details if IDs found
-    # Otherwise perform a Place Details query to API
-    for id in response.json()["places"]:
-        with db.get_store() as store:
-            # id["id"] is the place id found with query
-            saved_item = store.get(namespace=("restaurants",), key=id['id'])
-        if saved_item:
-            place["name"] = saved_item.value["name"]
-            place["reviews"] = saved_item.value["reviews"]
-            place["rating"] = saved_item.value["rating"]
-            place["delivery"] = saved_item.value["delivery"]
-            place["maps_uri"] = saved_item.value["maps_uri"]
-            place["photo"] = saved_item.value["photo"]
-            place_list.append(place.copy())
-    
-        else:
-            # When the place is not found locally, query the name and reviews from API
-            # These are expensive queries, careful
-            
-            # Place Details (Basic) SKU: displayName | 0.0170 USD per each
-            # Place Details (Preferred) SKU: reviews | 0.025 USD per each
-
-            # Full set of totally new places: (0.017 + 0.025) * pageSize
-            # with 5 places, total 0,21 USD (2/24/2025)
-
-            url = f"https://places.googleapis.com/v1/places/{id['id']}"
-            headers = {
-                "Content-Type": "application/json",
-                "X-Goog-Api-Key": GMAPS_API_KEY,
-                "X-Goog-FieldMask": "reviews.text.text,displayName,delivery,photos,rating,googleMapsUri",
-            }
-        
-            response = requests.get(url, headers=headers)
-            data = response.json()
-
-            if "reviews" not in data.keys():
-                data["reviews"] = 'None'
-            
-            # Only get two reviews
-            # TODO: scheck sorting, is it better to get first or last indices
-            reviews = data["reviews"][:5]
-
-            # Formatting in case LLM needs to operate on these
-            formatted_list = []
-            i = 1
-            for rev in reviews:
-                if "text" not in rev.keys():
-                    formatted_list.append(f'Review not found')
-                    continue
-                formatted_list.append(f'Review {i}: {rev["text"]["text"]}')
-                i += 1
-            
-            # Get a photo of the place
-            selected_photo = data["photos"][0]["name"]
-            for photo in data["photos"]:
-                if data["displayName"]["text"] == photo["authorAttributions"][0]["displayName"]:
-                    selected_photo = photo["name"]
-                    break
-        
-            url = f"https://places.googleapis.com/v1/{selected_photo}/media?maxHeightPx={max_height}&maxWidthPx={max_width}&skipHttpRedirect=true"
-            headers = {
-                "Content-Type": "application/json",
-                "X-Goog-Api-Key": GMAPS_API_KEY,
-            }
-            response = requests.get(url, headers=headers)
-            photo_uri = response.json()["photoUri"]
-
-            if "delivery" not in data.keys():
-                data["delivery"] = "Unknown"
-            elif data["delivery"]:
-                data["delivery"] = "Available"
-            else:
-                data["delivery"] = "Not Available"
-
-            # Store the newly found place details, and append them to the output
-            with db.get_store() as store:
-                store.put(("restaurants",), 
-                           id['id'], 
-                           {
-                            "name": data["displayName"]["text"], 
-                            "reviews": formatted_list,
-                            "rating": data["rating"],
-                            "delivery": data["delivery"],
-                            "maps_uri": data["googleMapsUri"],
-                            "photo": photo_uri
-                           },
-                           index=["reviews"])
-            
-            place["name"] = data["displayName"]["text"]
-            place["reviews"] = formatted_list
-            place["rating"] = data["rating"]
-            place["delivery"] = data["delivery"]
-            place["maps_uri"] = data["googleMapsUri"]
-            place["photo"] = photo_uri
-            place_list.append(place.copy())
-            
-    return place_list
\ No newline at end of file
+    # With the async store open this never leaves the event loop, otherwise the blocking store runs in a thread
+    if db.async_store is not None:
+        saved, missing = await aget_cached_places(db, place_ids)
+    else:
+        saved, missing = await asyncio.to_thread(get_cached_places, db, place_ids)
+
+    # Fetched by an earlier request but not flushed yet
+    for id in missing:
+        pending = place_writer.get(id)
+        if pending is not None:
+            saved[id] = _place_value(pending)
+    missing = [id for id in missing if id not in saved]
+
+    # Stale records are served as they are, the refresher updates them off this path
+    refresh_stale(saved)
+
+    # This request's own records, details shared with other requests are only referenced
+    restaurants = {id: Restaurant.from_value(id, value) for id, value in saved.items()}
+
+    if on_place:
+        for id in place_ids:
+            if id in restaurants:
+                on_place(restaurants[id])
+
+    async def fetch(id: str) -> dict:
+        place = await get_place_details(id)
+        restaurants[id] = Restaurant.from_value(id, place)
+        if on_place:
+            on_place(restaurants[id])
+        return place
+
+    # Otherwise perform Place Details queries to API, all at once
+    fetched = await asyncio.gather(*(fetch(id) for id in missing))
+
+    # Store the newly found place details, this request uses them from memory
+    if place_writer.running:
+        await place_writer.submit(fetched)
+    else:
+        await store_places(db, fetched)
+
+    # Keep the order Text Search returned
+    return {id: restaurants[id] for id in place_ids}
@@ -0,0 +1,119 @@
+from typing import Awaitable, Callable
+from urllib.parse import urlencode
+import hashlib
+import hmac
+import os
+
+from utils.cache import LRUCache, PostgresTier
+from utils.singleflight import SingleFlight
+
+# Resolved photo URIs are kept this long, the place's photo reference itself never expires
+PHOTO_CACHE_TTL = float(os.getenv("PHOTO_CACHE_TTL", str(24 * 60 * 60)))
+PHOTO_CACHE_SIZE = int(os.getenv("PHOTO_CACHE_SIZE", "20000"))
+
+READ_QUERY = """
+    SELECT photo_uri FROM photo_cache
+    WHERE place_id = %s AND created_at > now() - make_interval(secs => %s)
+"""
+
+WRITE_QUERY = """
+    INSERT INTO photo_cache (place_id, photo_uri) VALUES (%s, %s)
+    ON CONFLICT (place_id) DO UPDATE
+    SET photo_uri = EXCLUDED.photo_uri, created_at = now()
+"""
+
+# Signs the photo references put in photo URLs, any worker can resolve them without the saved record
+PHOTO_URL_SECRET = os.getenv("PHOTO_URL_SECRET", os.getenv("JWT_SECRET_KEY", "")).encode()
+
+
+def sign_photo_ref(place_id: str, photo_ref: str) -> str:
+    return hmac.new(PHOTO_URL_SECRET, f"{place_id}|{photo_ref}".encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def verify_photo_ref(place_id: str, photo_ref: str, sig: str) -> bool:
+    """A reference from one of our URLs, and one of this place's photos."""
+    if not photo_ref.startswith(f"places/{place_id}/photos/"):
+        return False
+    return hmac.compare_digest(sign_photo_ref(place_id, photo_ref), sig)
+
+
+def photo_url(place_id: str, photo_ref: str | None = None) -> str:
+    """
+    Stable URL the client renders, resolved to the real image by /api/photo/{place_id}.
+    With the photo reference signed into it, the image resolves even before the place is saved.
+    """
+    if not photo_ref:
+        return f"/api/photo/{place_id}"
+    query = urlencode({"ref": photo_ref, "sig": sign_photo_ref(place_id, photo_ref)})
+    return f"/api/photo/{place_id}?{query}"
+
+
+class PhotoCache(PostgresTier):
+    """
+    place id -> resolved photo URI.
+    In-process LRU first, then the photo_cache table in Postgres, shared by all workers.
+    Concurrent lookups of the same place share one resolution.
+    """
+
+    LABEL = "Photo cache"
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS photo_cache (
+            place_id TEXT PRIMARY KEY,
+            photo_uri TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+    )
+
+    def __init__(self, ttl: float = PHOTO_CACHE_TTL, maxsize: int = PHOTO_CACHE_SIZE):
+        super().__init__()
+        self.ttl = ttl
+        self.lru = LRUCache(maxsize, ttl=ttl)
+        self._flight = SingleFlight()
+        self.db_hits = 0
+        self.resolved = 0
+
+
+    async def _resolve(self, place_id: str, resolver: Callable[[str], Awaitable[str | None]]) -> str | None:
+        rows = await self._aread(READ_QUERY, (place_id, self.ttl))
+        if rows:
+            photo_uri = rows[0]["photo_uri"]
+            self.db_hits += 1
+        else:
+            photo_uri = await resolver(place_id)
+            if photo_uri is None:
+                return None
+            self.resolved += 1
+            await self._awrite(WRITE_QUERY, (place_id, photo_uri))
+
+        self.lru.set(place_id, photo_uri)
+        return photo_uri
+
+
+    async def get(self, place_id: str, resolver: Callable[[str], Awaitable[str | None]]) -> str | None:
+        """
+        Photo URI of a place, resolver is called only when neither tier has it.
+
+        Args:
+            place_id (str): Place ID
+            resolver (Callable): Coroutine function place_id -> photo URI, None if the place is unknown
+
+        Returns:
+            str | None: Photo URI
+        """
+        photo_uri = self.lru.get(place_id)
+        if photo_uri is not None:
+            return photo_uri
+
+        return await self._flight.do(place_id, lambda: self._resolve(place_id, resolver))
+
+
+    def stats(self) -> dict:
+        return {
+            **self.lru.stats(),
+            "db_hits": self.db_hits,
+            "resolved": self.resolved,
+            "deduplicated": self._flight.shared,
+            "inflight": len(self._flight),
+        }
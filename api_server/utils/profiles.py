@@ -0,0 +1,234 @@
+from psycopg.types.json import Jsonb # type: ignore
+import numpy as np # type: ignore
+import uuid
+
+from utils.graph_utils import is_negative_preference
+from utils.ranking import cosine_similarity, stored_vectors, astored_vectors
+
+# One compact record per user, updated whenever a preference is saved
+PROFILE_NAMESPACE = ("profiles",)
+
+# Preferences closer than this to an existing one replace it instead of growing the profile
+DEDUP_THRESHOLD = 0.95
+
+# Page size when rebuilding a profile from the raw ("users", user_id) history
+HISTORY_PAGE_SIZE = 100
+
+# pg_advisory_xact_lock(class, key) class for profile updates, the key is hashtext(user_id)
+PROFILE_LOCK_CLASS = 1
+
+# Saves for the same user are read-modify-write on one record, serialized across all API workers
+# by a transaction level advisory lock. The record is read and written on the lock's connection
+PROFILE_LOCK_QUERY = "SELECT pg_advisory_xact_lock(%s, hashtext(%s))"
+
+PROFILE_READ_QUERY = "SELECT value FROM store WHERE prefix = %s AND key = %s"
+
+PROFILE_WRITE_QUERY = """
+    INSERT INTO store (prefix, key, value) VALUES (%s, %s, %s)
+    ON CONFLICT (prefix, key) DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP
+"""
+
+# A rebuilt profile only goes in if no save has written one meanwhile
+PROFILE_CREATE_QUERY = """
+    INSERT INTO store (prefix, key, value) VALUES (%s, %s, %s)
+    ON CONFLICT (prefix, key) DO NOTHING
+"""
+
+
+def empty_profile() -> dict:
+    return {"version": 0, "preferences": []}
+
+
+def add_to_profile(profile: dict | None, vectors: np.ndarray | None,
+                   key: str, text: str, vector: list[float]) -> tuple[dict, np.ndarray]:
+    """
+    Add a preference to a profile, with its negation/target classification precomputed.
+    A near-identical preference replaces the old one, newest wording wins.
+    Vectors are not kept in the profile, they are already in store_vectors under the preference key.
+
+    Args:
+        vectors (np.ndarray | None): Vectors of the profile's preferences, in profile order
+
+    Returns:
+        tuple[dict, np.ndarray]: The profile, keys "version" and "preferences", each preference has
+                                 "key", "preference", "negative", "target". And its vectors, in the same order
+    """
+    profile = profile or empty_profile()
+    vector = np.asarray(vector, dtype=np.float32)
+    entry = {
+        "key": key,
+        "preference": text,
+        "negative": is_negative_preference(text),
+        "target": text.lower(),
+    }
+
+    preferences = profile["preferences"]
+    # Profiles written before vectors were left out carried them inline
+    for pref in preferences:
+        pref.pop("vector", None)
+
+    if preferences:
+        similarity = cosine_similarity(vector, vectors)[0]
+        closest = int(np.argmax(similarity))
+        if similarity[closest] >= DEDUP_THRESHOLD:
+            preferences[closest] = entry
+            vectors = vectors.copy()
+            vectors[closest] = vector
+        else:
+            preferences.append(entry)
+            vectors = np.vstack([vectors, vector])
+    else:
+        preferences.append(entry)
+        vectors = vector[None, :]
+
+    profile["version"] += 1
+    return profile, vectors
+
+
+def _profile_keys(profile: dict) -> tuple[list[str], list[str]]:
+    preferences = profile["preferences"]
+    return [pref["key"] for pref in preferences], [pref["preference"] for pref in preferences]
+
+
+def profile_vectors(db, user_id: str, profile: dict, conn=None) -> np.ndarray:
+    """Vectors of the profile's preferences in profile order, one store_vectors read."""
+    return stored_vectors(db, ("users", user_id), "preference", *_profile_keys(profile), conn=conn)
+
+
+async def aprofile_vectors(db, user_id: str, profile: dict, conn=None) -> np.ndarray:
+    return await astored_vectors(db, ("users", user_id), "preference", *_profile_keys(profile), conn=conn)
+
+
+def _fold_history(history: list, vectors: np.ndarray) -> dict:
+    # history is oldest first, vectors in the same order
+    profile, profile_vecs = None, None
+    for item, vector in zip(history, vectors):
+        profile, profile_vecs = add_to_profile(profile, profile_vecs, item.key, item.value["preference"], vector)
+    return profile or empty_profile()
+
+
+def _rebuild_profile(db, user_id: str) -> dict:
+    # Users saved before profiles existed, fold the whole history in once
+    history = []
+    with db.get_store() as store:
+        while True:
+            page = store.search(("users", user_id), limit=HISTORY_PAGE_SIZE, offset=len(history))
+            history.extend(page)
+            if len(page) < HISTORY_PAGE_SIZE:
+                break
+
+    history.sort(key=lambda item: item.created_at)
+    keys = [item.key for item in history]
+    texts = [item.value["preference"] for item in history]
+    return _fold_history(history, stored_vectors(db, ("users", user_id), "preference", keys, texts))
+
+
+async def _arebuild_profile(db, user_id: str) -> dict:
+    history = []
+    async with db.get_async_store() as store:
+        while True:
+            page = await store.asearch(("users", user_id), limit=HISTORY_PAGE_SIZE, offset=len(history))
+            history.extend(page)
+            if len(page) < HISTORY_PAGE_SIZE:
+                break
+
+    history.sort(key=lambda item: item.created_at)
+    keys = [item.key for item in history]
+    texts = [item.value["preference"] for item in history]
+    return _fold_history(history, await astored_vectors(db, ("users", user_id), "preference", keys, texts))
+
+
+def load_profile(db, user_id: str) -> dict:
+    """
+    The user's preference profile, one small record read.
+    """
+    with db.get_store() as store:
+        item = store.get(PROFILE_NAMESPACE, user_id)
+    if item:
+        return item.value
+
+    profile = _rebuild_profile(db, user_id)
+    with db.pool.connection() as conn:
+        conn.execute(PROFILE_CREATE_QUERY, (PROFILE_NAMESPACE[0], user_id, Jsonb(profile)))
+    return profile
+
+
+def save_preference(db, user_id: str, text: str) -> dict:
+    """
+    Append the raw preference to the ("users", user_id) history and update the profile incrementally.
+
+    Returns:
+        dict: The updated profile
+    """
+    key = str(uuid.uuid4())
+
+    # Goes through the embedding cache, the indexed put below reuses this vector
+    vector = db.embeddings.embed_documents([text])[0]
+
+    with db.get_store() as store:
+        store.put(("users", user_id),
+                    key,
+                    {
+                     "preference": text,
+                    },
+                    index=["preference"])
+        item = store.get(PROFILE_NAMESPACE, user_id)
+
+    # Without a profile the rebuild already includes the history put above.
+    # Done before taking the lock, it needs more than the lock's connection
+    rebuilt = None if item else _rebuild_profile(db, user_id)
+
+    with db.pool.connection() as conn:
+        with conn.transaction():
+            conn.execute(PROFILE_LOCK_QUERY, (PROFILE_LOCK_CLASS, user_id))
+            row = conn.execute(PROFILE_READ_QUERY, (PROFILE_NAMESPACE[0], user_id)).fetchone()
+            if row:
+                profile = row["value"]
+                vectors = profile_vectors(db, user_id, profile, conn=conn)
+                profile, _ = add_to_profile(profile, vectors, key, text, vector)
+            else:
+                profile = rebuilt or add_to_profile(None, None, key, text, vector)[0]
+            conn.execute(PROFILE_WRITE_QUERY, (PROFILE_NAMESPACE[0], user_id, Jsonb(profile)))
+
+    return profile
+
+
+async def aload_profile(db, user_id: str) -> dict:
+    """Async load_profile, for the async graph."""
+    async with db.get_async_store() as store:
+        item = await store.aget(PROFILE_NAMESPACE, user_id)
+    if item:
+        return item.value
+
+    profile = await _arebuild_profile(db, user_id)
+    async with db.async_pool.connection() as conn:
+        await conn.execute(PROFILE_CREATE_QUERY, (PROFILE_NAMESPACE[0], user_id, Jsonb(profile)))
+    return profile
+
+
+async def asave_preference(db, user_id: str, text: str) -> dict:
+    """Async save_preference, for the async graph."""
+    key = str(uuid.uuid4())
+
+    vector = (await db.embeddings.aembed_documents([text]))[0]
+
+    async with db.get_async_store() as store:
+        await store.aput(("users", user_id), key, {"preference": text}, index=["preference"])
+        item = await store.aget(PROFILE_NAMESPACE, user_id)
+
+    rebuilt = None if item else await _arebuild_profile(db, user_id)
+
+    async with db.async_pool.connection() as conn:
+        async with conn.transaction():
+            await conn.execute(PROFILE_LOCK_QUERY, (PROFILE_LOCK_CLASS, user_id))
+            cur = await conn.execute(PROFILE_READ_QUERY, (PROFILE_NAMESPACE[0], user_id))
+            row = await cur.fetchone()
+            if row:
+                profile = row["value"]
+                vectors = await aprofile_vectors(db, user_id, profile, conn=conn)
+                profile, _ = add_to_profile(profile, vectors, key, text, vector)
+            else:
+                profile = rebuilt or add_to_profile(None, None, key, text, vector)[0]
+            await conn.execute(PROFILE_WRITE_QUERY, (PROFILE_NAMESPACE[0], user_id, Jsonb(profile)))
+
+    return profile
@@ -0,0 +1,153 @@
+from collections import OrderedDict
+import numpy as np # type: ignore
+import threading
+import time
+import os
+
+from utils.graph_utils import is_negative_preference
+from utils.ranking import cosine_similarity
+from utils.search_cache import normalize_query
+
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2000"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", str(24 * 60 * 60)))
+# Inputs at least this close to a cached one reuse its query
+QUERY_CACHE_THRESHOLD = float(os.getenv("QUERY_CACHE_THRESHOLD", "0.95"))
+
+
+class SemanticQueryCache:
+    """
+    Cache of query_formulator outputs.
+    Exact match on the normalized input first, then nearest neighbour on the input embedding.
+    LRU + TTL eviction, the neighbour search is one matrix product over the live entries.
+    A neighbour only counts if it has the same negation, "no sushi" embeds right next to "sushi".
+    """
+
+    def __init__(self, maxsize: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL,
+                 threshold: float = QUERY_CACHE_THRESHOLD):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self.embeddings = None
+        # normalized input -> (vector, query, expires_at, negative)
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._keys = []
+        self._negative = None
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+
+    def bind(self, embeddings):
+        """Embeddings used for the nearest neighbour lookup, without them only exact matches hit."""
+        self.embeddings = embeddings
+
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = [key for key, (_, _, expires_at, _) in self._entries.items() if expires_at < now]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+
+    def _nearest(self, vector, negative: bool) -> str | None:
+        if self._matrix is None:
+            self._keys = list(self._entries.keys())
+            self._matrix = np.asarray([self._entries[key][0] for key in self._keys], dtype=np.float32)
+            self._negative = np.asarray([self._entries[key][3] for key in self._keys], dtype=bool)
+        if not self._keys:
+            return None
+
+        similarity = cosine_similarity(np.asarray(vector, dtype=np.float32), self._matrix)[0]
+        similarity[self._negative != negative] = -np.inf
+        best = int(np.argmax(similarity))
+        if similarity[best] >= self.threshold:
+            return self._keys[best]
+        return None
+
+
+    def _exact(self, key: str) -> str | None:
+        with self._lock:
+            self._expire()
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return self._entries[key][1]
+        return None
+
+
+    def _semantic(self, vector, negative: bool) -> str | None:
+        with self._lock:
+            self._expire()
+            nearest = self._nearest(vector, negative)
+            if nearest is not None and nearest in self._entries:
+                self._entries.move_to_end(nearest)
+                self.semantic_hits += 1
+                return self._entries[nearest][1]
+
+        self.misses += 1
+        return None
+
+
+    def _store(self, key: str, vector, query: str, negative: bool):
+        with self._lock:
+            self._entries[key] = (vector, query, time.monotonic() + self.ttl, negative)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+
+    def get(self, text: str) -> str | None:
+        key = normalize_query(text)
+        query = self._exact(key)
+        if query is not None:
+            return query
+
+        if self.embeddings is None:
+            self.misses += 1
+            return None
+
+        # Embedded outside the lock, the embedding cache makes repeats free
+        return self._semantic(self.embeddings.embed_query(text), is_negative_preference(text))
+
+
+    async def aget(self, text: str) -> str | None:
+        key = normalize_query(text)
+        query = self._exact(key)
+        if query is not None:
+            return query
+
+        if self.embeddings is None:
+            self.misses += 1
+            return None
+
+        return self._semantic(await self.embeddings.aembed_query(text), is_negative_preference(text))
+
+
+    def set(self, text: str, query: str):
+        vector = self.embeddings.embed_query(text) if self.embeddings is not None else []
+        self._store(normalize_query(text), vector, query, is_negative_preference(text))
+
+
+    async def aset(self, text: str, query: str):
+        vector = await self.embeddings.aembed_query(text) if self.embeddings is not None else []
+        self._store(normalize_query(text), vector, query, is_negative_preference(text))
+
+
+    def stats(self) -> dict:
+        total = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.semantic_hits) / total if total else 0.0,
+        }
+
+
+query_cache = SemanticQueryCache()
@@ -0,0 +1,80 @@
+import numpy as np # type: ignore
+import json
+
+from utils.restaurant import Restaurant
+
+
+def cosine_similarity(queries: np.ndarray, docs: np.ndarray) -> np.ndarray:
+    """
+    Cosine similarity between every query row and every doc row.
+    Same metric the store uses, larger is more similar.
+
+    Returns:
+        np.ndarray: Shape (len(queries), len(docs))
+    """
+    queries = np.atleast_2d(queries)
+    docs = np.atleast_2d(docs)
+    q_norm = np.linalg.norm(queries, axis=1, keepdims=True)
+    d_norm = np.linalg.norm(docs, axis=1, keepdims=True)
+    q_norm[q_norm == 0] = 1.0
+    d_norm[d_norm == 0] = 1.0
+    return (queries / q_norm) @ (docs / d_norm).T
+
+
+def review_text(reviews) -> str:
+    # The exact text the store embeds for a list field, keeps the embedding cache hitting
+    return json.dumps(reviews, sort_keys=True, ensure_ascii=False)
+
+
+def _missing(keys: list[str], texts: list[str], vectors: dict) -> dict:
+    return {key: text for key, text in zip(keys, texts) if key not in vectors}
+
+
+def _stack(db, keys: list[str], vectors: dict) -> np.ndarray:
+    if not keys:
+        return np.zeros((0, db.dims), dtype=np.float32)
+    return np.asarray([vectors[key] for key in keys], dtype=np.float32)
+
+
+def stored_vectors(db, namespace: tuple, field: str, keys: list[str], texts: list[str], conn=None) -> np.ndarray:
+    """
+    Vectors of store Items, read from store_vectors in one query.
+    Items without a stored vector (not saved yet, or saved unindexed) have their text embedded (cached) in one batch.
+
+    Args:
+        namespace (tuple): Store namespace, e.g. ("restaurants",) or ("users", user_id)
+        field (str): Indexed field, e.g. "reviews"
+        keys (list[str]): Item keys
+        texts (list[str]): The field's text of each item, as the store embeds it
+        conn: Connection held by the caller, see ConnectPostgres.get_vectors
+
+    Returns:
+        np.ndarray: Shape (len(keys), dims), in key order
+    """
+    vectors = db.get_vectors(namespace, keys, field, conn=conn)
+    missing = _missing(keys, texts, vectors)
+    if missing:
+        vectors.update(zip(missing, db.embeddings.embed_documents(list(missing.values()))))
+    return _stack(db, keys, vectors)
+
+
+async def astored_vectors(db, namespace: tuple, field: str, keys: list[str], texts: list[str], conn=None) -> np.ndarray:
+    """Async stored_vectors, reads through the async pool."""
+    vectors = await db.aget_vectors(namespace, keys, field, conn=conn)
+    missing = _missing(keys, texts, vectors)
+    if missing:
+        vectors.update(zip(missing, await db.embeddings.aembed_documents(list(missing.values()))))
+    return _stack(db, keys, vectors)
+
+
+def _review_items(restaurant_list: list[Restaurant]) -> tuple[list[str], list[str]]:
+    return [restaurant.id for restaurant in restaurant_list], [review_text(restaurant.reviews) for restaurant in restaurant_list]
+
+
+def get_review_vectors(db, restaurant_list: list[Restaurant]) -> np.ndarray:
+    """Review vectors of the restaurants, in list order."""
+    return stored_vectors(db, ("restaurants",), "reviews", *_review_items(restaurant_list))
+
+
+async def aget_review_vectors(db, restaurant_list: list[Restaurant]) -> np.ndarray:
+    return await astored_vectors(db, ("restaurants",), "reviews", *_review_items(restaurant_list))
@@ -0,0 +1,205 @@
+from typing import Awaitable, Callable
+from collections import OrderedDict
+import threading
+import asyncio
+import time
+import os
+
+from utils.cache import LRUCache
+from utils.errors import RateLimitError
+
+# Refresh calls are paid Place Details, kept well under the quota left for users.
+# Rate and budget are for the whole server, every API worker runs its own refresher
+API_WORKERS = int(os.getenv("API_WORKERS", "1"))
+# One call per 20 s at most, the daily budget is what actually bounds the cost
+REFRESH_RATE = float(os.getenv("REFRESH_RATE", "0.05")) / API_WORKERS
+# Place Details calls per UTC day, ~2000 keeps about 14k places fresh at the default 7 day TTL
+REFRESH_DAILY_BUDGET = int(os.getenv("REFRESH_DAILY_BUDGET", "2000")) // API_WORKERS
+REFRESH_BURST = int(os.getenv("REFRESH_BURST", "5"))
+REFRESH_BATCH_SIZE = int(os.getenv("REFRESH_BATCH_SIZE", "20"))
+# Seconds between checks of an empty queue
+REFRESH_INTERVAL = float(os.getenv("REFRESH_INTERVAL", "5"))
+REFRESH_QUEUE_MAX = int(os.getenv("REFRESH_QUEUE_MAX", "5000"))
+# Pause after Google answers 429
+REFRESH_BACKOFF = float(os.getenv("REFRESH_BACKOFF", "60"))
+# Failed ids are not retried before this
+REFRESH_RETRY_AFTER = float(os.getenv("REFRESH_RETRY_AFTER", str(60 * 60)))
+
+
+class TokenBucket:
+    """
+    Allows `rate` acquisitions per second on average, bursts up to `burst`.
+    Only used from the event loop, no locking.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class BackgroundRefresher:
+    """
+    Refreshes stale records off the request path.
+    Requests only enqueue ids and keep serving the stale record, a single worker task
+    fetches them in batches through a token bucket and saves the results.
+    """
+
+    def __init__(self, fetch: Callable[[str], Awaitable[dict]],
+                 save: Callable[[object, list[dict]], Awaitable[None]],
+                 rate: float = REFRESH_RATE, burst: int = REFRESH_BURST,
+                 batch_size: int = REFRESH_BATCH_SIZE, interval: float = REFRESH_INTERVAL,
+                 max_pending: int = REFRESH_QUEUE_MAX, daily_budget: int = REFRESH_DAILY_BUDGET):
+        self.fetch = fetch
+        self.save = save
+        self.bucket = TokenBucket(rate, burst)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.daily_budget = daily_budget
+        self._day = self._today()
+        self._spent = 0
+        self.db = None
+        self._task: asyncio.Task | None = None
+        # Enqueued from worker threads too (blocking store paths)
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._inflight = set()
+        self._failed = LRUCache(10000, ttl=REFRESH_RETRY_AFTER)
+        self.enqueued = 0
+        self.dropped = 0
+        self.refreshed = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+
+    @staticmethod
+    def _today() -> int:
+        return int(time.time() // (24 * 60 * 60))
+
+
+    def budget_left(self) -> int:
+        """Fetches left for today, the count starts over at UTC midnight."""
+        today = self._today()
+        if today != self._day:
+            self._day = today
+            self._spent = 0
+        return max(self.daily_budget - self._spent, 0)
+
+
+    def enqueue(self, ids: list[str]):
+        """Queue ids for a refresh, already queued, in-flight and recently failed ones are skipped."""
+        with self._lock:
+            for id in ids:
+                if id in self._pending or id in self._inflight or self._failed.get(id):
+                    continue
+                if len(self._pending) >= self.max_pending:
+                    self.dropped += 1
+                    continue
+                self._pending[id] = None
+                self.enqueued += 1
+
+
+    def _take(self) -> list[str]:
+        # Charged when taken, failed and rate limited fetches still cost
+        limit = min(self.batch_size, self.budget_left())
+        with self._lock:
+            batch = []
+            while self._pending and len(batch) < limit:
+                id, _ = self._pending.popitem(last=False)
+                batch.append(id)
+            self._inflight.update(batch)
+            self._spent += len(batch)
+            return batch
+
+
+    async def _fetch(self, id: str) -> dict:
+        await self.bucket.acquire()
+        return await self.fetch(id)
+
+
+    async def _refresh(self, batch: list[str]):
+        results = await asyncio.gather(*(self._fetch(id) for id in batch), return_exceptions=True)
+
+        places = []
+        limited = []
+        for id, result in zip(batch, results):
+            if isinstance(result, RateLimitError):
+                limited.append(id)
+            elif isinstance(result, Exception):
+                print(f"Refresh failed for {id}: {result}")
+                self.failed += 1
+                self._failed.set(id, True)
+            else:
+                places.append(result)
+
+        try:
+            if places:
+                await self.save(self.db, places)
+                self.refreshed += len(places)
+        finally:
+            with self._lock:
+                self._inflight.difference_update(batch)
+
+        if limited:
+            # Quota is shared with users, back off and try these later
+            self.rate_limited += len(limited)
+            self.enqueue(limited)
+            print(f"Refresh rate limited, pausing {REFRESH_BACKOFF}s")
+            await asyncio.sleep(REFRESH_BACKOFF)
+
+
+    async def _run(self):
+        while True:
+            # Out of budget the ids stay queued (stale records keep being served) until tomorrow
+            batch = self._take()
+            if not batch:
+                await asyncio.sleep(self.interval)
+                continue
+            try:
+                await self._refresh(batch)
+            except Exception as e:
+                # Never let one bad batch stop the worker
+                print(f"Refresh batch failed: {e}")
+
+
+    def start(self, db):
+        """Start the worker on the running loop."""
+        self.db = db
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "inflight": len(self._inflight),
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "refreshed": self.refreshed,
+            "failed": self.failed,
+            "rate_limited": self.rate_limited,
+            "budget_left": self.budget_left(),
+        }
@@ -0,0 +1,57 @@
+from dataclasses import dataclass
+
+from utils.photos import photo_url
+
+
+@dataclass(slots=True)
+class Restaurant:
+    """
+    One restaurant as it moves through a request, keyed by its place id.
+    Built per request from a saved ("restaurants",) value or fresh Place Details, the reviews list
+    is that record's own list, referenced and never copied. Ranking fills in pref_note and score.
+    """
+
+    id: str
+    name: str
+    reviews: list[str]
+    rating: float
+    delivery: str
+    maps_uri: str
+    photo_ref: str | None = None
+    lat: float | None = None
+    lon: float | None = None
+    # 'boost', 'none' or 'pop', see check_preference_score
+    pref_note: str = "none"
+    score: float = 0.0
+
+
+    @classmethod
+    def from_value(cls, id: str, value: dict) -> "Restaurant":
+        # Records saved before coordinates or photo references were stored have neither
+        return cls(
+            id=id,
+            name=value["name"],
+            reviews=value["reviews"],
+            rating=value["rating"],
+            delivery=value["delivery"],
+            maps_uri=value["maps_uri"],
+            photo_ref=value.get("photo_ref"),
+            lat=value.get("lat"),
+            lon=value.get("lon"),
+        )
+
+
+    @property
+    def photo(self) -> str:
+        return photo_url(self.id, self.photo_ref)
+
+
+    def to_payload(self) -> dict:
+        """The fields the client shows for a restaurant, as sent in the SSE events."""
+        return {
+            "name": self.name,
+            "rating": self.rating,
+            "delivery": self.delivery,
+            "maps_uri": self.maps_uri,
+            "photo": self.photo,
+        }
@@ -0,0 +1,193 @@
+from collections import Counter
+import threading
+import random
+import math
+import os
+import re
+
+from utils.cache import PostgresTier
+
+ROUTES = ("no", "save", "end")
+
+# Local decision is used only above this posterior, everything else goes to the LLM router
+ROUTER_FAST_PATH = os.getenv("ROUTER_FAST_PATH", "true").lower() == "true"
+ROUTER_CONFIDENCE = float(os.getenv("ROUTER_CONFIDENCE", "0.9"))
+# Don't trust the model before it has seen this many logged routes
+ROUTER_MIN_EXAMPLES = int(os.getenv("ROUTER_MIN_EXAMPLES", "200"))
+# Share of confident inputs still sent to the LLM, keeps the agreement rate honest
+ROUTER_SHADOW_RATE = float(os.getenv("ROUTER_SHADOW_RATE", "0.05"))
+# Most recent logged routes used for training on startup
+ROUTER_TRAIN_LIMIT = int(os.getenv("ROUTER_TRAIN_LIMIT", "20000"))
+
+# Logs the route and drops whatever fell out of the training window, the table stays at
+# ROUTER_TRAIN_LIMIT rows. A few ids are lost to rollbacks, so it can keep slightly fewer
+LOG_QUERY = """
+    WITH logged AS (INSERT INTO route_log (input, route) VALUES (%s, %s) RETURNING id)
+    DELETE FROM route_log WHERE id <= (SELECT id FROM logged) - %s
+"""
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+
+def tokenize(text: str) -> list[str]:
+    # Words and bigrams, "don't like" and "not hungry" need the context
+    words = TOKEN_PATTERN.findall(text.lower())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class RouteClassifier(PostgresTier):
+    """
+    Multinomial naive Bayes over words and bigrams, trained from routes the LLM router has decided.
+    Predicting is a few dict lookups, so obvious inputs skip the reasoning model entirely.
+    Learns online: every escalated input is logged to route_log and added to the counts.
+    """
+
+    LABEL = "Route log"
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS route_log (
+            id BIGSERIAL PRIMARY KEY,
+            input TEXT NOT NULL,
+            route TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+    )
+
+    def __init__(self, confidence: float = ROUTER_CONFIDENCE, min_examples: int = ROUTER_MIN_EXAMPLES,
+                 shadow_rate: float = ROUTER_SHADOW_RATE):
+        super().__init__()
+        self.confidence = confidence
+        self.min_examples = min_examples
+        self.shadow_rate = shadow_rate
+        self._lock = threading.Lock()
+        self._token_counts = {route: Counter() for route in ROUTES}
+        self._token_totals = {route: 0 for route in ROUTES}
+        self._doc_counts = {route: 0 for route in ROUTES}
+        self._vocab = set()
+        self.local = 0
+        self.escalated = 0
+        self.compared = 0
+        self.agreed = 0
+        # Only the shadowed inputs that would have been routed locally
+        self.shadow_compared = 0
+        self.shadow_agreed = 0
+
+
+    def load(self, limit: int = ROUTER_TRAIN_LIMIT):
+        """Train from the most recent logged routes."""
+        if self.pool is None:
+            return
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT input, route FROM route_log ORDER BY id DESC LIMIT %s",
+                                (limit,)).fetchall()
+        for row in rows:
+            self.learn(row["input"], row["route"])
+
+
+    def learn(self, text: str, route: str):
+        if route not in ROUTES:
+            return
+        tokens = tokenize(text)
+        with self._lock:
+            self._token_counts[route].update(tokens)
+            self._token_totals[route] += len(tokens)
+            self._doc_counts[route] += 1
+            self._vocab.update(tokens)
+
+
+    def log(self, text: str, route: str):
+        """Learn from an LLM decided route and persist it for the next startup."""
+        self.learn(text, route)
+        self._write(LOG_QUERY, (text, route, ROUTER_TRAIN_LIMIT))
+
+
+    async def alog(self, text: str, route: str):
+        self.learn(text, route)
+        await self._awrite(LOG_QUERY, (text, route, ROUTER_TRAIN_LIMIT))
+
+
+    @property
+    def examples(self) -> int:
+        return sum(self._doc_counts.values())
+
+
+    def predict(self, text: str) -> tuple[str | None, float]:
+        """
+        Returns:
+            tuple[str | None, float]: Most likely route and its posterior, (None, 0.0) before any training
+        """
+        examples = self.examples
+        if not examples:
+            return None, 0.0
+
+        tokens = tokenize(text)
+        vocab_size = len(self._vocab) + 1
+
+        # Log posteriors with Laplace smoothing
+        scores = {}
+        with self._lock:
+            for route in ROUTES:
+                docs = self._doc_counts[route]
+                if not docs:
+                    continue
+                counts = self._token_counts[route]
+                denominator = self._token_totals[route] + vocab_size
+                score = math.log(docs / examples)
+                for token in tokens:
+                    score += math.log((counts[token] + 1) / denominator)
+                scores[route] = score
+
+        best = max(scores, key=scores.get)
+        top = scores[best]
+        total = sum(math.exp(score - top) for score in scores.values())
+        return best, 1.0 / total
+
+
+    def decide(self, text: str) -> tuple[str | None, str | None, bool]:
+        """
+        Returns:
+            tuple: The route to use without the LLM (None means escalate),
+                   the local guess to compare against the LLM answer,
+                   and whether the guess was confident enough to be used
+        """
+        if not ROUTER_FAST_PATH:
+            return None, None, False
+
+        route, confidence = self.predict(text)
+        trusted = self.examples >= self.min_examples and confidence >= self.confidence
+
+        if trusted and random.random() >= self.shadow_rate:
+            self.local += 1
+            return route, route, True
+
+        self.escalated += 1
+        return None, route, trusted
+
+
+    def record(self, local_route: str | None, trusted: bool, llm_route: str):
+        if local_route is None:
+            return
+        agree = local_route == llm_route
+        self.compared += 1
+        self.agreed += agree
+        if trusted:
+            self.shadow_compared += 1
+            self.shadow_agreed += agree
+
+
+    def stats(self) -> dict:
+        routed = self.local + self.escalated
+        return {
+            "examples": self.examples,
+            "local": self.local,
+            "escalated": self.escalated,
+            "local_rate": self.local / routed if routed else 0.0,
+            "compared": self.compared,
+            "agreement_rate": self.agreed / self.compared if self.compared else 0.0,
+            "shadow_compared": self.shadow_compared,
+            "shadow_agreement_rate": self.shadow_agreed / self.shadow_compared if self.shadow_compared else 0.0,
+        }
+
+
+route_classifier = RouteClassifier()
@@ -0,0 +1,133 @@
+import math
+import os
+import re
+
+from utils.cache import LRUCache, PostgresTier
+
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", str(6 * 60 * 60)))
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "5000"))
+SEARCH_CACHE_DB_MAX_ROWS = int(os.getenv("SEARCH_CACHE_DB_MAX_ROWS", "200000"))
+
+# ~550 m of latitude, close enough that the 1 km location bias returns the same places
+GEO_CELL_DEG = float(os.getenv("SEARCH_CACHE_CELL_DEG", "0.005"))
+
+# Expired and overflow rows are cleaned up every this many writes
+PRUNE_EVERY = 100
+
+READ_QUERY = """
+    SELECT place_ids FROM search_cache
+    WHERE key = %s AND created_at > now() - make_interval(secs => %s)
+"""
+
+WRITE_QUERY = """
+    INSERT INTO search_cache (key, place_ids) VALUES (%s, %s)
+    ON CONFLICT (key) DO UPDATE
+    SET place_ids = EXCLUDED.place_ids, created_at = now()
+"""
+
+PRUNE_EXPIRED_QUERY = "DELETE FROM search_cache WHERE created_at < now() - make_interval(secs => %s)"
+
+PRUNE_OVERFLOW_QUERY = """
+    DELETE FROM search_cache WHERE key IN (
+        SELECT key FROM search_cache ORDER BY created_at DESC OFFSET %s
+    )
+"""
+
+
+def normalize_query(query: str) -> str:
+    # LLM output comes with stray quotes, punctuation and newlines
+    query = re.sub(r"[^\w\s&'-]", " ", query.lower())
+    return " ".join(query.split())
+
+
+def geo_cell(lat: float, lon: float, cell_deg: float = GEO_CELL_DEG) -> tuple[int, int]:
+    return math.floor(lat / cell_deg), math.floor(lon / cell_deg)
+
+
+class SearchCache(PostgresTier):
+    """
+    TTL cache of Text Search results: (normalized query, geo cell, radius) -> ordered place ids.
+    In-process LRU first, then the search_cache table in Postgres, shared by all workers.
+    """
+
+    LABEL = "Search cache"
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS search_cache (
+            key TEXT PRIMARY KEY,
+            place_ids TEXT[] NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS search_cache_created_at_idx ON search_cache (created_at)",
+    )
+
+    def __init__(self, ttl: float = SEARCH_CACHE_TTL, maxsize: int = SEARCH_CACHE_SIZE,
+                 db_max_rows: int = SEARCH_CACHE_DB_MAX_ROWS):
+        super().__init__()
+        self.ttl = ttl
+        self.db_max_rows = db_max_rows
+        self.lru = LRUCache(maxsize, ttl=ttl)
+        self.db_hits = 0
+        self.misses = 0
+        self._writes = 0
+
+
+    def key(self, query: str, location: dict, radius: float) -> str:
+        lat_cell, lon_cell = geo_cell(location["lat"], location["lon"])
+        return f"{normalize_query(query)}|{lat_cell}|{lon_cell}|{radius:g}"
+
+
+    def _loaded(self, key: str, rows: list[dict]) -> list[str] | None:
+        if rows:
+            self.db_hits += 1
+            self.lru.set(key, rows[0]["place_ids"])
+            return rows[0]["place_ids"]
+        self.misses += 1
+        return None
+
+
+    def _prune_due(self) -> bool:
+        self._writes += 1
+        return self._writes % PRUNE_EVERY == 0
+
+
+    def get(self, key: str) -> list[str] | None:
+        place_ids = self.lru.get(key)
+        if place_ids is not None:
+            return place_ids
+        return self._loaded(key, self._read(READ_QUERY, (key, self.ttl)))
+
+
+    def set(self, key: str, place_ids: list[str]):
+        self.lru.set(key, place_ids)
+        self._write(WRITE_QUERY, (key, place_ids))
+        if self._prune_due():
+            self._write(PRUNE_EXPIRED_QUERY, (self.ttl,))
+            self._write(PRUNE_OVERFLOW_QUERY, (self.db_max_rows,))
+
+
+    async def aget(self, key: str) -> list[str] | None:
+        place_ids = self.lru.get(key)
+        if place_ids is not None:
+            return place_ids
+        return self._loaded(key, await self._aread(READ_QUERY, (key, self.ttl)))
+
+
+    async def aset(self, key: str, place_ids: list[str]):
+        self.lru.set(key, place_ids)
+        await self._awrite(WRITE_QUERY, (key, place_ids))
+        if self._prune_due():
+            await self._awrite(PRUNE_EXPIRED_QUERY, (self.ttl,))
+            await self._awrite(PRUNE_OVERFLOW_QUERY, (self.db_max_rows,))
+
+
+    def stats(self) -> dict:
+        lru = self.lru.stats()
+        total = lru["hits"] + self.db_hits + self.misses
+        return {
+            **lru,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": (lru["hits"] + self.db_hits) / total if total else 0.0,
+        }
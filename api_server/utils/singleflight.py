@@ -0,0 +1,105 @@
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable
+import asyncio
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one in-flight call.
+    Nothing is cached, the key is free again as soon as the call finishes.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.shared = 0
+
+
+    def _finished(self, key: Hashable, future: asyncio.Future):
+        self._calls.pop(key, None)
+        # Mark the error retrieved, every waiter may have gone away already
+        if not future.cancelled():
+            future.exception()
+
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run fn() unless a call for key is already in flight, then wait for that one instead.
+
+        Returns:
+            Any: Result of the shared call, its exception is raised to every caller
+        """
+        future = self._calls.get(key)
+        if future is None:
+            self.calls += 1
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._finished(key, f))
+        else:
+            self.shared += 1
+
+        # One caller hanging up doesn't cancel the call the others are waiting on
+        return await asyncio.shield(future)
+
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "shared": self.shared, "inflight": len(self._calls)}
+
+
+class SharedStream:
+    """
+    One run of an async iterator, fanned out to any number of subscribers.
+    Subscribers get a queue that starts with every item so far, so late ones replay from the beginning.
+    An exception from the source is delivered as an item, END marks the end.
+    The source is cancelled when the last subscriber leaves before it is done.
+    """
+
+    END = object()
+
+    def __init__(self, source: AsyncIterator, on_done: Callable[["SharedStream"], None] | None = None):
+        self._items = []
+        self._queues: set[asyncio.Queue] = set()
+        self._on_done = on_done
+        self.done = False
+        self._task = asyncio.create_task(self._pump(source))
+
+
+    def _publish(self, item):
+        self._items.append(item)
+        for queue in self._queues:
+            queue.put_nowait(item)
+
+
+    async def _pump(self, source: AsyncIterator):
+        try:
+            async for item in source:
+                self._publish(item)
+        except Exception as e:
+            self._publish(e)
+        finally:
+            self.done = True
+            self._publish(SharedStream.END)
+            if self._on_done:
+                self._on_done(self)
+
+
+    def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in self._items:
+            queue.put_nowait(item)
+        self._queues.add(queue)
+        return queue
+
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._queues.discard(queue)
+        if not self._queues and not self.done:
+            self._task.cancel()
+
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._queues)
@@ -0,0 +1,103 @@
+from contextlib import contextmanager
+import time
+import os
+
+# Bump when any of the setup() migrations run at startup change
+SCHEMA_VERSION = "2"
+
+# pg_advisory_lock key, workers starting together run the migrations one at a time
+MIGRATION_LOCK_ID = 80235
+# Seconds between pg_try_advisory_lock attempts of a worker waiting for the migrations
+MIGRATION_LOCK_POLL = 0.5
+
+
+class Startup:
+    """
+    Readiness of the API and the time each init phase took.
+    The server answers liveness checks right away, ready only once everything is warm.
+    """
+
+    def __init__(self):
+        self.state = "starting"
+        self.error = None
+        self.phases: dict[str, float] = {}
+        self.started = time.monotonic()
+        self.total = None
+
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time a block of the startup, logged and kept for /api/ready."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = round((time.monotonic() - started) * 1000, 1)
+            print(f"Startup phase {name} [{os.getpid()}]: {self.phases[name]} ms")
+
+
+    def done(self):
+        self.state = "ready"
+        self.total = round((time.monotonic() - self.started) * 1000, 1)
+        print(f"Startup ready [{os.getpid()}] in {self.total} ms")
+
+
+    def fail(self, error: Exception):
+        self.state = "failed"
+        self.error = str(error)
+        print(f"Startup failed [{os.getpid()}]: {error}")
+
+
+    def stats(self) -> dict:
+        return {"pid": os.getpid(), "state": self.state, "error": self.error, "phases": self.phases, "total_ms": self.total}
+
+
+def _ensure_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_versions (
+            component TEXT PRIMARY KEY,
+            version TEXT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+
+
+def schema_current(pool, component: str, version: str) -> bool:
+    """Whether the migrations of a component already ran at this version."""
+    with pool.connection() as conn:
+        _ensure_table(conn)
+        row = conn.execute("SELECT version FROM schema_versions WHERE component = %s", (component,)).fetchone()
+    return row is not None and row["version"] == version
+
+
+def mark_schema(pool, component: str, version: str):
+    with pool.connection() as conn:
+        conn.execute("""
+            INSERT INTO schema_versions (component, version) VALUES (%s, %s)
+            ON CONFLICT (component) DO UPDATE SET version = EXCLUDED.version, updated_at = now()
+        """, (component, version))
+
+
+@contextmanager
+def migration_lock(pool, poll: float = MIGRATION_LOCK_POLL):
+    """
+    Session level advisory lock, held on its own connection until the block exits.
+    Waiters poll instead of blocking in pg_advisory_lock: a blocked statement keeps its snapshot,
+    and the holder's CREATE INDEX CONCURRENTLY would wait on that snapshot forever.
+    """
+    with pool.connection() as conn:
+        # Autocommit connections, nothing is held between the attempts
+        while not conn.execute("SELECT pg_try_advisory_lock(%s) AS locked", (MIGRATION_LOCK_ID,)).fetchone()["locked"]:
+            time.sleep(poll)
+        try:
+            yield
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+
+
+startup = Startup()
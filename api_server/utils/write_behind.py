@@ -0,0 +1,134 @@
+from typing import Awaitable, Callable
+from collections import OrderedDict
+import asyncio
+import os
+
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "2000"))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "100"))
+# Longest a record waits for its batch to fill up, seconds
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "1.0"))
+# Wait before retrying a batch that failed to save
+WRITE_BEHIND_RETRY_DELAY = float(os.getenv("WRITE_BEHIND_RETRY_DELAY", "5.0"))
+
+
+class WriteBehindQueue:
+    """
+    Records are saved in batches by a background task, the caller doesn't wait for the write.
+    Pending records are keyed by id, the newest value wins and can be read back with get()
+    until it has been saved. Memory is bounded: submit() waits for a flush when full.
+    """
+
+    def __init__(self, save: Callable[[object, list[dict]], Awaitable[None]],
+                 max_pending: int = WRITE_BEHIND_MAX_PENDING, batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+                 interval: float = WRITE_BEHIND_INTERVAL):
+        self.save = save
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.interval = interval
+        self.db = None
+        self._pending: OrderedDict[str, dict] = OrderedDict()
+        self._task: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Condition()
+        self.submitted = 0
+        self.saved = 0
+        self.batches = 0
+        self.failures = 0
+        self.waits = 0
+
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+
+    def get(self, id: str) -> dict | None:
+        """A record that is submitted but not saved yet."""
+        return self._pending.get(id)
+
+
+    async def submit(self, records: list[dict]):
+        for record in records:
+            if len(self._pending) >= self.max_pending and record["id"] not in self._pending:
+                # Backpressure only when the database can't keep up
+                self.waits += 1
+                self._wakeup.set()
+                async with self._space:
+                    await self._space.wait_for(lambda: len(self._pending) < self.max_pending)
+            self._pending[record["id"]] = record
+            self.submitted += 1
+
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+
+    async def _flush_batch(self) -> bool:
+        batch = list(self._pending.items())[:self.batch_size]
+        if not batch:
+            return False
+
+        await self.save(self.db, [record for _, record in batch])
+        self.saved += len(batch)
+        self.batches += 1
+
+        for id, record in batch:
+            # Resubmitted while saving, the newer value goes in the next batch
+            if self._pending.get(id) is record:
+                del self._pending[id]
+        async with self._space:
+            self._space.notify_all()
+        return True
+
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                while await self._flush_batch():
+                    pass
+            except Exception as e:
+                # Kept pending, retried on the next round
+                self.failures += 1
+                print(f"Write-behind flush failed, {len(self._pending)} pending: {e}")
+                await asyncio.sleep(WRITE_BEHIND_RETRY_DELAY)
+
+
+    def start(self, db):
+        """Start the flusher on the running loop."""
+        self.db = db
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+
+
+    async def close(self):
+        """Stop the flusher and save everything still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        while self._pending:
+            try:
+                await self._flush_batch()
+            except Exception as e:
+                print(f"Write-behind final flush failed, {len(self._pending)} records lost: {e}")
+                break
+
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "submitted": self.submitted,
+            "saved": self.saved,
+            "batches": self.batches,
+            "failures": self.failures,
+            "waits": self.waits,
+        }
@@ -0,0 +1,230 @@
+"""
+Warm the ("restaurants",) namespace for an area before users get there.
+
+Walks a grid over a bounding box, runs every query at every grid point and saves the
+details of places that are not saved yet, the same way the online path does.
+
+    python warm_cache.py --bbox 60.15 24.88 60.20 24.98 --step 1000 \
+        --queries sushi pizza "thai food" --checkpoint helsinki.json
+
+Interrupted runs continue from the checkpoint. Set PLACES_API_URL to run against a stub Places server.
+"""
+from langchain_google_genai import GoogleGenerativeAIEmbeddings # type: ignore
+import argparse
+import asyncio
+import json
+import math
+import time
+import os
+
+import utils.maps as maps
+from utils.db_client import ConnectPostgres
+from utils.embeddings import CachedEmbeddings
+from utils.errors import RateLimitError
+
+# Place Details (Basic) + (Preferred), see maps.fetch_place_details. Text Search for ids is free
+DETAILS_COST_USD = float(os.getenv("DETAILS_COST_USD", str(0.017 + 0.025)))
+
+# Seconds to wait after Google answers 429
+RATE_LIMIT_BACKOFF = 60.0
+
+
+def cell_key(lat: float, lon: float, query: str) -> str:
+    return f"{lat},{lon}|{query}"
+
+
+def grid_points(lat_min: float, lon_min: float, lat_max: float, lon_max: float, step: float) -> list[tuple[float, float]]:
+    """Grid over the box, step in meters, longitude spacing corrected for latitude."""
+    lat_step = step / 111320.0
+    lon_step = step / (111320.0 * max(math.cos(math.radians((lat_min + lat_max) / 2)), 0.01))
+
+    points = []
+    lat = lat_min
+    while lat <= lat_max:
+        lon = lon_min
+        while lon <= lon_max:
+            points.append((round(lat, 6), round(lon, 6)))
+            lon += lon_step
+        lat += lat_step
+    return points
+
+
+class Checkpoint:
+    """Finished (point, query) cells and counters, in a JSON file."""
+
+    def __init__(self, path: str | None):
+        self.path = path
+        self.done = set()
+        self.stats = {"searches": 0, "found": 0, "already_saved": 0, "fetched": 0, "failed": 0}
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.done = set(data["done"])
+            self.stats.update(data["stats"])
+            print(f"Resuming from {path}: {len(self.done)} cells done")
+
+
+    def save(self):
+        if not self.path:
+            return
+        # Written aside and swapped in, a crash mid-write keeps the previous checkpoint
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"done": sorted(self.done), "stats": self.stats}, f)
+        os.replace(tmp, self.path)
+
+
+class Warmer:
+    def __init__(self, db: ConnectPostgres, checkpoint: Checkpoint, concurrency: int):
+        self.db = db
+        self.checkpoint = checkpoint
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # Ids already handled this run, neighbouring cells return mostly the same places
+        self.seen = set()
+        self.started = time.monotonic()
+        self.fetched_this_run = 0
+        # Not checkpointed, a rerun with the same checkpoint retries these cells
+        self.failed_cells = 0
+
+
+    async def fetch(self, place_id: str) -> dict | None:
+        try:
+            return await maps.get_place_details(place_id)
+        except RateLimitError:
+            raise
+        except Exception as e:
+            # Missing photos, closed places etc, skip them
+            print(f"Details failed for {place_id}: {e}")
+            self.checkpoint.stats["failed"] += 1
+            return None
+
+
+    async def cell(self, lat: float, lon: float, query: str):
+        key = cell_key(lat, lon, query)
+
+        async with self.semaphore:
+            while True:
+                new_ids = []
+                try:
+                    place_ids = await maps.search_place_ids(query, {"lat": lat, "lon": lon})
+                    self.checkpoint.stats["searches"] += 1
+
+                    new_ids = [id for id in place_ids if id not in self.seen]
+                    self.seen.update(new_ids)
+                    self.checkpoint.stats["found"] += len(new_ids)
+
+                    saved, missing = await asyncio.to_thread(maps.get_cached_places, self.db, new_ids)
+                    self.checkpoint.stats["already_saved"] += len(saved)
+
+                    # A rate limit on one fetch doesn't cancel the others, what came back is already paid for
+                    fetched = await asyncio.gather(*(self.fetch(id) for id in missing), return_exceptions=True)
+                    places = [place for place in fetched if isinstance(place, dict)]
+                    failed = [id for id, place in zip(missing, fetched) if not isinstance(place, dict)]
+
+                    # One insert batch and one embedding call for the cell
+                    await maps.store_places(self.db, places)
+                    self.checkpoint.stats["fetched"] += len(places)
+                    self.fetched_this_run += len(places)
+
+                    if failed:
+                        # Stored ones come back from get_cached_places, the retry only fetches these
+                        self.seen.difference_update(failed)
+                        if any(isinstance(place, RateLimitError) for place in fetched):
+                            print(f"Rate limited, waiting {RATE_LIMIT_BACKOFF}s")
+                            await asyncio.sleep(RATE_LIMIT_BACKOFF)
+                            continue
+                        # Not checkpointed, a rerun fetches the failed ones again
+                        print(f"Cell {key}: {len(failed)} details failed")
+                        self.failed_cells += 1
+                        return
+                    break
+                except RateLimitError:
+                    print(f"Rate limited, waiting {RATE_LIMIT_BACKOFF}s")
+                    # Nothing of the cell was saved, let the retry pick them up
+                    self.seen.difference_update(new_ids)
+                    await asyncio.sleep(RATE_LIMIT_BACKOFF)
+                except ValueError:
+                    # Nothing matched the query here
+                    break
+                except Exception as e:
+                    # Timeouts, API and database errors, one cell never stops the grid
+                    print(f"Cell {key} failed: {e!r}")
+                    self.seen.difference_update(new_ids)
+                    self.failed_cells += 1
+                    return
+
+            # Only checkpointed once the cell's places are in the store
+            self.checkpoint.done.add(key)
+            self.checkpoint.save()
+
+
+    def report(self, cells_done: int, cells_total: int):
+        elapsed = time.monotonic() - self.started
+        stats = self.checkpoint.stats
+        print(f"{cells_done}/{cells_total} cells | "
+              f"{stats['searches']} searches, {stats['found']} places found, "
+              f"{stats['already_saved']} already saved, {stats['fetched']} fetched, {stats['failed']} failed, "
+              f"{self.failed_cells} cells failed | "
+              f"{self.fetched_this_run / elapsed:.2f} places/s this run | "
+              f"est. cost {stats['fetched'] * DETAILS_COST_USD:.2f} USD")
+
+
+async def warm(args):
+    EMBED_MODEL_NAME = "models/text-embedding-004"
+    DIMS = 768
+
+    embeddings = CachedEmbeddings(GoogleGenerativeAIEmbeddings(model=EMBED_MODEL_NAME), EMBED_MODEL_NAME)
+    db = ConnectPostgres(embeddings, DIMS)
+    embeddings.bind(db.cache_pool)
+    maps.search_cache.bind(db.pool)
+
+    with db.get_store() as store:
+        store.setup()
+    db.setup_geo_index()
+    embeddings.setup()
+    maps.search_cache.setup()
+
+    points = grid_points(*args.bbox, args.step)
+    cells = [(lat, lon, query) for lat, lon in points for query in args.queries]
+    print(f"{len(points)} grid points x {len(args.queries)} queries = {len(cells)} cells")
+
+    checkpoint = Checkpoint(args.checkpoint)
+    warmer = Warmer(db, checkpoint, args.concurrency)
+
+    remaining = [cell for cell in cells if cell_key(*cell) not in checkpoint.done]
+    print(f"{len(cells) - len(remaining)} cells already done")
+
+    tasks = [asyncio.create_task(warmer.cell(*cell)) for cell in remaining]
+    try:
+        for i, task in enumerate(asyncio.as_completed(tasks), 1):
+            await task
+            if i % args.report_every == 0 or i == len(tasks):
+                warmer.report(len(cells) - len(remaining) + i, len(cells))
+        if warmer.failed_cells:
+            print(f"{warmer.failed_cells} cells failed, run again with the same --checkpoint to retry them")
+    finally:
+        for task in tasks:
+            task.cancel()
+        checkpoint.save()
+        await maps.close_client()
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prefetch restaurants for an area into the restaurants namespace.")
+    parser.add_argument("--bbox", type=float, nargs=4, required=True,
+                        metavar=("LAT_MIN", "LON_MIN", "LAT_MAX", "LON_MAX"))
+    parser.add_argument("--step", type=float, default=maps.SEARCH_RADIUS,
+                        help="Grid spacing in meters, defaults to the search radius")
+    parser.add_argument("--queries", nargs="+", required=True, help="Cuisine queries run at every grid point")
+    parser.add_argument("--concurrency", type=int, default=4, help="Grid cells processed at once")
+    parser.add_argument("--checkpoint", help="JSON file to resume from and save progress to")
+    parser.add_argument("--report-every", type=int, default=10)
+    args = parser.parse_args()
+
+    asyncio.run(warm(args))
+
+
+if __name__ == "__main__":
+    main()
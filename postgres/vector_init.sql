@@ -1,2 +1,5 @@
 -- Enable pgvector extension
-CREATE EXTENSION IF NOT EXISTS vector;
\ No newline at end of file
+CREATE EXTENSION IF NOT EXISTS vector;
+
+-- The ANN index on store_vectors is managed by the API at startup (ConnectPostgres.migrate_ann_index),
+-- kind and parameters come from ANN_INDEX_KIND / ANN_HNSW_* / ANN_IVFFLAT_LISTS.
@@ -21,6 +21,9 @@ const PodiumUI = () => {
 
   
   const API_URL = import.meta.env.VITE_APP_BACKEND_ADDRESS; 
+
+  // Photos come as /api/photo/{place_id}, resolved by the backend
+  const photoSrc = (photo) => (photo?.startsWith("/") ? `${API_URL}${photo}` : photo);
   
   class RetriableError extends Error { }
   class FatalError extends Error { }
@@ -32,6 +35,7 @@ const PodiumUI = () => {
     if (event.key === "Enter" && inputValue.trim() !== "" && !isSubmitting) {
       setIsSubmitting(true);
       setError("")  
+      let candidatesShown = false;
       try {
             if ("geolocation" in navigator) {
                 // Wait for location before proceeding
@@ -81,6 +85,19 @@ const PodiumUI = () => {
                         setStreamData(data.output);
                     }
 
+                    // Restaurants keyed by place id, shown unranked as they resolve
+                    if (data.status === "candidates") {
+                        if (!candidatesShown) {
+                          candidatesShown = true;
+                          setPodiumData(data.output);
+                          setShowPodium(true);
+                          setStartIndex(0);
+                        } else {
+                          setPodiumData((prev) => ({ ...prev, ...data.output }));
+                        }
+                    }
+
+                    // Ranked list replaces the candidates
                     if (data.status === "complete") {
                         console.log("Podium data:", data.output);
                         setPodiumData(data.output)
@@ -171,13 +188,13 @@ const PodiumUI = () => {
                 onClick={() => handleCardClick({
                   title: value.name,
                   rating: value.rating,
-                  image: value.photo, // Placeholder, replace with API data if available
+                  image: photoSrc(value.photo), // Placeholder, replace with API data if available
                   googleMaps: value.maps_uri,
                   delivery: value.delivery,
                 })}
               >
                 <div className="card-image">
-                  <img src={value.photo} alt={value.name} />
+                  <img src={photoSrc(value.photo)} alt={value.name} loading="lazy" />
                 </div>
                 <div className="card-content">{value.name}</div>
               </div>